@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python_modules")
+)
+
+from fasta import Fasta
+from poly_detector import RegexDetector, RunLengthDetector, batched
+
+
+def synthetic_proteome(proteins, mean_length, seed=1):
+    """Random proteins with the residue usage of a vertebrate proteome and some homorepeats."""
+    random.seed(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    weights = [7, 2, 5, 7, 4, 7, 3, 4, 6, 10, 2, 4, 6, 5, 6, 8, 5, 6, 1, 3]
+    sequences = []
+    for _ in range(proteins):
+        sequence = random.choices(residues, weights, k=random.randint(50, 2 * mean_length))
+        for _ in range(random.randint(0, 3)):
+            position = random.randrange(len(sequence))
+            sequence[position:position] = random.choice("QAEPS") * random.randint(4, 25)
+        sequences.append("".join(sequence))
+    return sequences
+
+
+def time_detector(detector, sequences, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        matches = []
+        for batch in batched(sequences):
+            matches.extend(detector.find_batch(batch))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the regex and run-length homorepeat detectors."
+    )
+    parser.add_argument("-f", "--fasta", help="Protein fasta file, a synthetic proteome is used otherwise")
+    parser.add_argument("-n", "--proteins", help="Proteins in the synthetic proteome", default=20000, type=int)
+    parser.add_argument("-aa", "--amino_acids", help="Residues to scan", default="QAEPS")
+    parser.add_argument("-s", "--size", help="Minimum homorepeat size", default=5, type=int)
+    parser.add_argument("-mb", "--max_breaks", help="Comma-separated break tolerances", default="0,1,2,3")
+    parser.add_argument("-r", "--rounds", help="Best of this many rounds", default=3, type=int)
+    args = parser.parse_args()
+
+    if args.fasta:
+        sequences = [sequence for _, sequence in Fasta.parse_generator(args.fasta)]
+    else:
+        sequences = synthetic_proteome(args.proteins, 450)
+    residues = sum(len(sequence) for sequence in sequences)
+    print(f"{len(sequences)} proteins, {residues} residues")
+    print(f"{'aa':>3} {'breaks':>6} {'regex s':>9} {'rle s':>9} {'speedup':>8} {'repeats':>8}")
+
+    for max_breaks in [int(value) for value in args.max_breaks.split(",")]:
+        for amino_acid in args.amino_acids:
+            regex_time, regex_matches = time_detector(
+                RegexDetector(amino_acid, args.size, max_breaks), sequences, args.rounds
+            )
+            rle_time, rle_matches = time_detector(
+                RunLengthDetector(amino_acid, args.size, max_breaks), sequences, args.rounds
+            )
+            if regex_matches != rle_matches:
+                sys.exit(f"Detectors disagree for {amino_acid} with {max_breaks} breaks")
+            repeats = sum(len(matches) for matches in rle_matches)
+            print(
+                f"{amino_acid:>3} {max_breaks:>6} {regex_time:>9.3f} {rle_time:>9.3f} "
+                f"{regex_time / rle_time:>7.2f}x {repeats:>8}"
+            )
@@ -0,0 +1,82 @@
+import argparse
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python_modules")
+)
+
+from fasta import Fasta
+
+# Line ends of the synthetic file, with the whitespace the readers strip from every sequence line
+LINE_ENDS = ["\n", "\n", "\n", "\r\n", " \n", "\t\n", " \t\r\n"]
+
+
+def synthetic_fasta(path, records, mean_length, seed=1):
+    """Writes random nucleotide records wrapped at 60 to 80 columns, with stray
+    whitespace around the sequence lines, blank lines and CRLF line ends."""
+    random.seed(seed)
+    with open(path, "w", newline="") as fasta_file:
+        for number in range(records):
+            fasta_file.write(f">seq{number} GeneID:{number} synthetic record{random.choice(LINE_ENDS)}")
+            sequence = "".join(random.choices("ACGT", k=random.randint(1, 2 * mean_length)))
+            width = random.randint(60, 80)
+            for start in range(0, len(sequence), width):
+                indent = " " if random.random() < 0.01 else ""
+                fasta_file.write(indent + sequence[start : start + width] + random.choice(LINE_ENDS))
+            if random.random() < 0.05:
+                fasta_file.write("\n")
+
+
+def time_reader(path, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        records = list(Fasta.parse_offset_generator(path))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks that the memory-mapped and gzip fasta readers give the same records, and times them."
+    )
+    parser.add_argument("-f", "--fasta", help="Plain fasta file, a synthetic one is used otherwise")
+    parser.add_argument("-n", "--records", help="Records of the synthetic file", default=20000, type=int)
+    parser.add_argument("-r", "--rounds", help="Best of this many rounds", default=3, type=int)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        plain_path = os.path.join(work_dir, "records.fna")
+        if args.fasta:
+            shutil.copy(args.fasta, plain_path)
+        else:
+            synthetic_fasta(plain_path, args.records, 1500)
+        gzip_path = f"{plain_path}.gz"
+        with open(plain_path, "rb") as plain_file, gzip.open(gzip_path, "wb", compresslevel=1) as gzip_file:
+            shutil.copyfileobj(plain_file, gzip_file)
+
+        mmap_time, mmap_records = time_reader(plain_path, args.rounds)
+        gzip_time, gzip_records = time_reader(gzip_path, args.rounds)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if mmap_records != gzip_records:
+        mismatch = next(
+            (index for index, (mmap_record, gzip_record) in enumerate(zip(mmap_records, gzip_records)) if mmap_record != gzip_record),
+            min(len(mmap_records), len(gzip_records)),
+        )
+        sys.exit(f"Readers disagree at record {mismatch} ({len(mmap_records)} memory-mapped, {len(gzip_records)} gzip records)")
+
+    bases = sum(len(sequence) for _, _, sequence in mmap_records)
+    print(f"{len(mmap_records)} records, {bases} bases, same records from both readers")
+    print(f"{'reader':>6} {'s':>8} {'Mbases/s':>9}")
+    for name, elapsed in [("mmap", mmap_time), ("gzip", gzip_time)]:
+        print(f"{name:>6} {elapsed:>8.3f} {bases / elapsed / 1e6:>9.1f}")
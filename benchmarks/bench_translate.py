@@ -0,0 +1,65 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python_modules")
+)
+
+from Bio.Data.CodonTable import standard_dna_table
+
+from fasta import Fasta
+from translate import translate_sequence, translate_sequence_biopython
+
+
+def synthetic_cds(sequences, mean_codons, seed=1):
+    """Random coding sequences, a start codon, sense codons and a final stop codon."""
+    random.seed(seed)
+    sense_codons = list(standard_dna_table.forward_table)
+    return [
+        "ATG"
+        + "".join(random.choices(sense_codons, k=random.randint(50, 2 * mean_codons)))
+        + random.choice(standard_dna_table.stop_codons)
+        for _ in range(sequences)
+    ]
+
+
+def time_translator(translator, sequences, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        proteins = [translator(sequence) for sequence in sequences]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, proteins
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the Biopython and lookup table codon translators."
+    )
+    parser.add_argument("-f", "--fasta", help="CDS fasta file, synthetic sequences are used otherwise")
+    parser.add_argument("-n", "--sequences", help="Synthetic sequences", default=20000, type=int)
+    parser.add_argument("-r", "--rounds", help="Best of this many rounds", default=3, type=int)
+    args = parser.parse_args()
+
+    if args.fasta:
+        sequences = [sequence for _, sequence in Fasta.parse_generator(args.fasta)]
+    else:
+        sequences = synthetic_cds(args.sequences, 450)
+    bases = sum(len(sequence) for sequence in sequences)
+    print(f"{len(sequences)} sequences, {bases} bases")
+
+    biopython_time, biopython_proteins = time_translator(
+        translate_sequence_biopython, sequences, args.rounds
+    )
+    table_time, table_proteins = time_translator(translate_sequence, sequences, args.rounds)
+    if biopython_proteins != table_proteins:
+        sys.exit("Translators disagree")
+
+    print(f"{'translator':>10} {'s':>8} {'Mbases/s':>9}")
+    for name, elapsed in [("biopython", biopython_time), ("table", table_time)]:
+        print(f"{name:>10} {elapsed:>8.3f} {bases / elapsed / 1e6:>9.1f}")
+    print(f"speedup {biopython_time / table_time:.2f}x")
@@ -9,7 +9,11 @@ out_dir=$2
 prefix=$3
 
 data_dir=${data_dir:-"ncbi_data"}
+# writes the output files compressed with bgzip (.gz)
+compress_output=${compress_output:-false}
+# skips the files whose outputs are up to date with the manifest of an earlier run
+incremental=${incremental:-false}
 
 echo "Adding Gene_id"
 
-python3 add_gene_id.py -id /data/$input_dir -od /data/$out_dir -dd /data/$data_dir
+python3 add_gene_id.py -id /data/$input_dir -od /data/$out_dir -dd /data/$data_dir -co $compress_output -inc $incremental
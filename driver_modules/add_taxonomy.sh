@@ -8,6 +8,17 @@ input_dir=$1
 out_dir=$2
 prefix=$3
 
+# writes the output files compressed with bgzip (.gz)
+compress_output=${compress_output:-false}
+# skips the files whose outputs are up to date with the manifest of an earlier run
+incremental=${incremental:-false}
+# walks lineages with sqlite queries or over the memory mapped tree snapshot of the database
+taxonomy_backend=${taxonomy_backend:-sqlite}
+# keeps the taxonomy tree in memory in a service shared by the taxonomy steps of the run
+taxonomy_service=${taxonomy_service:-false}
+# seconds without queries after which the taxonomy service stops
+taxonomy_service_idle=${taxonomy_service_idle:-600}
+
 echo "Adding taxonomy"
 
 if [ -z "$taxonomy_database" ]; then
@@ -38,7 +49,10 @@ done
 # If all ranks are valid, proceed; otherwise, exit
 if [ "$all_valid" = true ]; then
     mkdir -p /data/$out_dir
-    python3 add_taxonomy_local.py -id /data/$input_dir -od /data/$out_dir -db $taxonomy_database -r "$rank"
+    if [ "$taxonomy_service" = true ]; then
+        python3 taxonomy_service.py -db $taxonomy_database -it $taxonomy_service_idle -d true
+    fi
+    python3 add_taxonomy_local.py -id /data/$input_dir -od /data/$out_dir -db $taxonomy_database -r "$rank" -co $compress_output -inc $incremental -tb $taxonomy_backend
 else
     echo "[Error] One or more ranks provided are invalid. Exiting."
     exit 1
@@ -17,6 +17,26 @@ fi
 removal=${removal:-true}
 # capitalized for posterity, python will auto capitalize it.
 break_poly=${break_poly:-True}
+# homorepeat detector, regex or rle (NumPy run-length scan)
+detector=${detector:-regex}
+# translates in memory like transeq -trim instead of running transeq in docker for every file
+single_pass=${single_pass:-false}
+# sqlite file caching translated proteins across runs, unset disables the cache
+translation_cache=${translation_cache:-}
+# size in MB above which the least recently used proteins are evicted from the cache
+translation_cache_size=${translation_cache_size:-1024}
+# number of files scanned in parallel
+workers=${workers:-1}
+# files bigger than this size in MB are split into shards, 0 disables sharding
+shard_size=${shard_size:-0}
+# writes the fasta outputs compressed with bgzip (.gz)
+compress_output=${compress_output:-false}
+# annotates identical proteins once per file or once per run
+dedup_scope=${dedup_scope:-file}
+# skips the files whose outputs are up to date with the manifest of an earlier run
+incremental=${incremental:-false}
+# copies the output files to the next folder, or hardlinks, reflinks or symlinks them
+placement=${placement:-copy}
 
 input_dir=$1
 out_dir=$2
@@ -30,18 +50,22 @@ fi
 
 start=$(echo "docker run --rm  -v $dir:/data pegi3s/seda:$merge_seda_docker_version /opt/SEDA/run-cli.sh")
 
-mkdir -p /data/$out_dir /data/${prefix}Annotate_Poly/translate_out
+mkdir -p /data/$out_dir /data/${prefix}Annotate_Poly
 
-# Loop over files in /data/Data
-for entry in /data/Data/*; do
-    entry_name=$(basename "$entry")
-    echo "File: $entry_name"
-    docker run --rm -v $dir:/data pegi3s/emboss transeq -sequence /data/$input_dir/$entry_name -outseq "/data/${prefix}Annotate_Poly/translate_out/$entry_name" -trim
-done
+if [ "$single_pass" != "true" ]; then
+    mkdir -p /data/${prefix}Annotate_Poly/translate_out
+
+    # Loop over files in /data/Data
+    for entry in /data/Data/*; do
+        entry_name=$(basename "$entry")
+        echo "File: $entry_name"
+        docker run --rm -v $dir:/data pegi3s/emboss transeq -sequence /data/$input_dir/$entry_name -outseq "/data/${prefix}Annotate_Poly/translate_out/$entry_name" -trim
+    done
+fi
 
 # Run poly_finder
 echo "Identify poly chains"
-python3 annotate_poly.py -id "/data/$input_dir" -od /data/${prefix}Annotate_Poly -aa "$aminoacid" -s "$size" -b $break_poly
+python3 annotate_poly.py -id "/data/$input_dir" -od /data/${prefix}Annotate_Poly -aa "$aminoacid" -s "$size" -b $break_poly ${max_breaks:+-mb $max_breaks} -dt $detector -sp $single_pass ${translation_cache:+-tc $translation_cache -tcs $translation_cache_size} -w $workers -ss $shard_size -co $compress_output -ds $dedup_scope -inc $incremental
 
 if [ "$removal" = "true" ] ; then
     if [ -d "/data/${prefix}Annotate_Poly/translate_out" ]; then
@@ -52,7 +76,12 @@ if [ "$removal" = "true" ] ; then
     fi
 fi
 
-for entry in /data/${prefix}Annotate_Poly/genome/*; do
-    entry_name=$(basename "$entry")
-    mv /data/${prefix}Annotate_Poly/genome/$entry_name /data/$out_dir/$entry_name
-done
\ No newline at end of file
+# incremental runs keep the genome outputs, the manifest checks they still exist
+if [ "$incremental" = "true" ]; then
+    python3 placement.py -id /data/${prefix}Annotate_Poly/genome -od /data/$out_dir -pm $placement
+else
+    for entry in /data/${prefix}Annotate_Poly/genome/*; do
+        entry_name=$(basename "$entry")
+        mv /data/${prefix}Annotate_Poly/genome/$entry_name /data/$out_dir/$entry_name
+    done
+fi
\ No newline at end of file
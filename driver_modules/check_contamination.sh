@@ -8,13 +8,28 @@ input_dir=$1
 out_dir=$2
 prefix=$3
 
+# skips the files whose outputs are up to date with the manifest of an earlier run
+incremental=${incremental:-false}
+# checks ancestry with sqlite queries or over the memory mapped tree snapshot of the database
+taxonomy_backend=${taxonomy_backend:-sqlite}
+# keeps the taxonomy tree in memory in a service shared by the taxonomy steps of the run
+taxonomy_service=${taxonomy_service:-false}
+# seconds without queries after which the taxonomy service stops
+taxonomy_service_idle=${taxonomy_service_idle:-600}
+# copies the classified files, or hardlinks, reflinks or symlinks them to the input files
+placement=${placement:-copy}
+
 echo "Checking for contamination."
 
 mkdir -p /data/$out_dir
 mkdir -p /data/"$prefix"CheckContamination
-mkdir  /data/"$prefix"CheckContamination/passed
-mkdir  /data/"$prefix"CheckContamination/contamination
+mkdir -p /data/"$prefix"CheckContamination/passed
+mkdir -p /data/"$prefix"CheckContamination/contamination
+
+if [ "$taxonomy_service" = true ]; then
+    python3 taxonomy_service.py -db $taxonomy_database -it $taxonomy_service_idle -d true
+fi
 
-python3 check_contamination.py -id /data/$input_dir -od /data/"$prefix"CheckContamination -db $taxonomy_database -tn $contamination_taxonomy
+python3 check_contamination.py -id /data/$input_dir -od /data/"$prefix"CheckContamination -db $taxonomy_database -tn "$contamination_taxonomy" -inc $incremental -tb $taxonomy_backend -pm $placement
 
-cp -v /data/"$prefix"CheckContamination/passed/* /data/$out_dir
+python3 placement.py -id /data/"$prefix"CheckContamination/passed -od /data/$out_dir -pm $placement
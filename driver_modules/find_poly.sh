@@ -18,6 +18,26 @@ fi
 removal=${removal:-true}
 # capitalized for posterity, python will auto capitalize it.
 break_poly=${break_poly:-True}
+# homorepeat detector, regex or rle (NumPy run-length scan)
+detector=${detector:-regex}
+# translates in memory while scanning instead of writing translate_out
+single_pass=${single_pass:-false}
+# sqlite file caching translated proteins across runs, unset disables the cache
+translation_cache=${translation_cache:-}
+# size in MB above which the least recently used proteins are evicted from the cache
+translation_cache_size=${translation_cache_size:-1024}
+# number of files scanned in parallel
+workers=${workers:-1}
+# files bigger than this size in MB are split into shards, 0 disables sharding
+shard_size=${shard_size:-0}
+# writes the fasta outputs compressed with bgzip (.gz)
+compress_output=${compress_output:-false}
+# report format, csv spreadsheets or a sqlite database per file
+report_format=${report_format:-csv}
+# skips the files whose outputs are up to date with the manifest of an earlier run
+incremental=${incremental:-false}
+# copies the output files to the next folder, or hardlinks, reflinks or symlinks them
+placement=${placement:-copy}
 
 input_dir=$1
 out_dir=$2
@@ -31,19 +51,23 @@ fi
 
 start=$(echo "docker run --rm  -v $dir:/data pegi3s/seda:$merge_seda_docker_version /opt/SEDA/run-cli.sh")
 
-mkdir -p /data/$out_dir /data/${prefix}Find_Poly/translate_out
+mkdir -p /data/$out_dir /data/${prefix}Find_Poly
 
-# Loop over files in /data/Data
-for entry in /data/$input_dir/*; do
-    entry_name=$(basename "$entry")
-    #docker run --rm -v $dir:/data pegi3s/emboss transeq -sequence /data/$input_dir/$entry_name -outseq "/data/${prefix}Find_Poly/translate_out/$entry_name" -trim
-    python3 translate.py /data/$input_dir/$entry_name /data/${prefix}Find_Poly/translate_out/$entry_name
-    echo "Finished translating: $entry_name"
-done
+if [ "$single_pass" != "true" ]; then
+    mkdir -p /data/${prefix}Find_Poly/translate_out
+
+    # Loop over files in /data/Data
+    for entry in /data/$input_dir/*; do
+        entry_name=$(basename "$entry")
+        #docker run --rm -v $dir:/data pegi3s/emboss transeq -sequence /data/$input_dir/$entry_name -outseq "/data/${prefix}Find_Poly/translate_out/$entry_name" -trim
+        python3 translate.py /data/$input_dir/$entry_name /data/${prefix}Find_Poly/translate_out/$entry_name ${translation_cache:+-tc $translation_cache -tcs $translation_cache_size}
+        echo "Finished translating: $entry_name"
+    done
+fi
 
 # Run poly_finder
 echo "Identify poly chains"
-python3 find_poly.py -id "/data/$input_dir" -od /data/${prefix}Find_Poly -aa "$aminoacid" -s "$size" -b $break_poly
+python3 find_poly.py -id "/data/$input_dir" -od /data/${prefix}Find_Poly -aa "$aminoacid" -s "$size" -b $break_poly ${max_breaks:+-mb $max_breaks} -dt $detector -sp $single_pass ${translation_cache:+-tc $translation_cache -tcs $translation_cache_size} -w $workers -ss $shard_size -co $compress_output -rf $report_format -inc $incremental
 
 if [ "$removal" = "true" ] ; then
     if [ -d "/data/${prefix}Find_Poly/translate_out" ]; then
@@ -54,14 +78,18 @@ if [ "$removal" = "true" ] ; then
     fi
 fi
 
-for entry in /data/${prefix}Find_Poly/matches_nucleotide/*; do
-    entry_name=$(basename "$entry")
-    cp /data/${prefix}Find_Poly/matches_nucleotide/$entry_name /data/$out_dir/$entry_name
-done
+python3 placement.py -id /data/${prefix}Find_Poly/matches_nucleotide -od /data/$out_dir -pm $placement
 
 mkdir /data/files_to_keep/poly_reports
 
-for entry in /data/${prefix}Find_Poly/reports_no_isoforms/*; do
+# sqlite reports flag the largest isoforms instead of having a separate report
+if [ "$report_format" = "sqlite" ]; then
+    report_dir=reports
+else
+    report_dir=reports_no_isoforms
+fi
+
+for entry in /data/${prefix}Find_Poly/$report_dir/*; do
     entry_name=$(basename "$entry")
     cp $entry /data/files_to_keep/poly_reports/$entry_name
 done
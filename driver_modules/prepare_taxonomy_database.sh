@@ -9,12 +9,19 @@ out_dir=$2
 prefix=$3
 
 download=${download:-"false"}
+# updates the taxonomy.db of an existing output directory in place with the changes of the new dump
+update=${update:-false}
 
 # Define the URL and target directory
 URL="https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/new_taxdump/new_taxdump.tar.gz"
 FILENAME="new_taxdump.tar.gz"
 
-if [ -d "$out_dir" ]; then
+if [ "$update" = "true" ]; then
+    if [ ! -f "/data/$out_dir/taxonomy.db" ]; then
+        echo "There is no taxonomy.db to update in /data/$out_dir. Exiting."
+        exit 1
+    fi
+elif [ -d "$out_dir" ]; then
     echo "The directory $out_dir already exists. Exiting."
     exit 1
 else
@@ -66,11 +73,16 @@ if [ $? -ne 0 ]; then
     exit 1
 fi
 
+if [ "$update" = "true" ]; then
+    # Lists of the merged and deleted tax IDs, used to account for the removed nodes
+    tar -xzf "$FILENAME" -C "$int_folder" merged.dmp delnodes.dmp 2>/dev/null || echo "No merged.dmp or delnodes.dmp in $FILENAME, removed nodes are taken from nodes.dmp alone."
+fi
+
 echo "Converting to database."
 
-mkdir /data/$out_dir
+mkdir -p /data/$out_dir
 
-python3 prepare_taxonomy_database.py -id "$int_folder" -od "/data/$out_dir"
+python3 prepare_taxonomy_database.py -id "$int_folder" -od "/data/$out_dir" -u $update
 
 # Clean up: remove the downloaded .tar.gz file if it was downloaded by this script
 if [ "$FILENAME" == "$int_folder/new_taxdump.tar.gz" ]; then
@@ -1,22 +1,9 @@
 import argparse
 import os
 import re
-
-def parse_generator(file):
-    """Simple FASTA file reader"""
-    sequence_id = None
-    sequence_data = []
-    for line in file:
-        line = line.strip()
-        if line.startswith('>'):
-            if sequence_id is not None:
-                yield sequence_id, ''.join(sequence_data)
-            sequence_id = line
-            sequence_data = []
-        else:
-            sequence_data.append(line)
-    if sequence_id is not None:
-        yield sequence_id, ''.join(sequence_data)
+from compression import open_output, output_path, resolve_path
+from fasta import Fasta
+from manifest import Manifest
 
 def get_gene_id(header):
     pattern = r"\[gene=(.*?)\]"
@@ -35,19 +22,27 @@ if __name__ == '__main__':
     parser.add_argument("-id", "--input_directory", required=True, help="Directory with input FASTA files")
     parser.add_argument("-dd", "--data_directory", required=True, help="Directory with data files containing GeneIDs")
     parser.add_argument("-od", "--output_directory", required=True, help="Directory to save output files")
+    parser.add_argument("-co", "--compress_output", required=False, default="False", choices=["True", "true", "False", "false"], help="Write the output files compressed with bgzip (.gz)")
+    parser.add_argument("-inc", "--incremental", required=False, default="False", choices=["True", "true", "False", "false"], help="Skip input files whose outputs are up to date with the manifest of an earlier run")
     args = parser.parse_args()
+    compress_output = args.compress_output.capitalize() == "True"
+    manifest = Manifest(args.output_directory, "add_gene_id", {"compress_output": compress_output}, args.incremental.capitalize() == "True")
 
-    for file_path in os.listdir(args.input_directory):
+    for file_path in Fasta.list_files(args.input_directory):
         file_name = os.path.basename(file_path)
+        # The data file may be compressed when the input is not, or the other way around
+        data_path = resolve_path(os.path.join(args.data_directory, file_name))
+        input_paths = [os.path.join(args.input_directory, file_path), data_path]
+        new_file_path = output_path(os.path.join(args.output_directory, file_name), compress_output)
+        if manifest.is_up_to_date(file_name, input_paths, [new_file_path]):
+            print(f"Up to date: {file_name}")
+            continue
         
-        with open(os.path.join(args.input_directory, file_path), "r") as input_file, \
-             open(os.path.join(args.data_directory, file_name), "r") as data_file, \
-             open(os.path.join(args.output_directory, file_name), "w") as output_file:
+        with open_output(new_file_path) as output_file:
 
-            input_generator = parse_generator(input_file)
-            data_generator = parse_generator(data_file)
-            
-            data_set = [item[0] for item in data_generator]  # Collect all headers from data file
+            input_generator = Fasta.parse_generator(os.path.join(args.input_directory, file_path))
+            # Collect all headers from data file, the sequences are never decoded
+            data_set = list(Fasta.header_generator(data_path))
 
             for input_item in input_generator:
                 protein_id = get_protein_id(input_item[0]).strip()
@@ -64,3 +59,5 @@ if __name__ == '__main__':
 
                 output_header = f"{input_item[0].strip()} [GeneID={gene_id}]"
                 output_file.write(f"{output_header}\n{input_item[1]}\n")
+
+        manifest.record(file_name, input_paths, [new_file_path])
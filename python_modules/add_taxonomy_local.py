@@ -2,13 +2,48 @@ import sqlite3
 import os
 import re
 import argparse
+import errno
+import mmap
+
+from compression import is_compressed, open_input, open_output, output_path, strip_compression_suffix
+from manifest import Manifest
+from taxonomy_service import connect_service
+from taxonomy_tree import TaxonomyTree, database_signature
+
+# Size of the output buffer the headers and short sequence spans are written through
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Sequence spans at least this long are copied file to file by the kernel
+KERNEL_COPY_SIZE = 1 << 20
+
+# Errors of a kernel copy the filesystem or platform does not support, the span is written instead
+KERNEL_COPY_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK}
 
 class TaxonomyDatabase:
     def __init__(self, db_file):
         self.conn = sqlite3.connect(db_file)
         self.cursor = self.conn.cursor()
-    
+        # Ranks stored for every tax ID by prepare_taxonomy_database, none in older databases
+        self.materialized_ranks = [row[1] for row in self.cursor.execute("PRAGMA table_info(ranks)")][1:]
+
     def find_rank_names(self, tax_id, ranks):
+        """Returns {rank: scientific name} of the lineage of tax_id, "Name not found" for the missing ranks."""
+        if ranks and all(rank in self.materialized_ranks for rank in ranks):
+            return self.find_materialized_rank_names(tax_id, ranks)
+        return self.find_rank_names_walk(tax_id, ranks)
+
+    def find_materialized_rank_names(self, tax_id, ranks):
+        """Reads every rank with a single lookup in the ranks table."""
+        columns = ", ".join(f'"{rank}"' for rank in ranks)
+        self.cursor.execute(f"SELECT {columns} FROM ranks WHERE tax_id = ?", (tax_id,))
+        result = self.cursor.fetchone()
+        if result is None:
+            print(f"[Warning] Tax ID {tax_id} not found in nodes table.")
+            result = [None] * len(ranks)
+        return {rank: name or "Name not found" for rank, name in zip(ranks, result)}
+
+    def find_rank_names_walk(self, tax_id, ranks):
+        """Walks up the tree with a query per ancestor, for databases without the ranks table."""
         current_tax_id = tax_id
         rank_names = {rank: "Name not found" for rank in ranks}
 
@@ -26,6 +61,8 @@ class TaxonomyDatabase:
                         rank_names[rank_value] = name_result[0]
                         ranks.remove(rank_value)  # Remove found rank from the list
 
+                if parent_tax_id == current_tax_id:
+                    break  # the root is its own parent in the NCBI dump
                 current_tax_id = parent_tax_id
             else:
                 print(f"[Warning] Tax ID {current_tax_id} not found in nodes table.")
@@ -38,18 +75,20 @@ class TaxonomyDatabase:
 
 # Function to extract tax_id from filename
 def extract_tax_id(filename):
-    match = re.search(r'_(\d+)(?:\.[^.]+)?$', filename)
+    match = re.search(r'_(\d+)(?:\.[^.]+)?$', strip_compression_suffix(filename))
     return match.group(1) if match else None
 
+def rank_string(rank_names):
+    return "_".join(rank_names.values()).replace(" ", "_")
+
 def modify_fasta_headers(fasta_file, rank_names):
     """Generator that reads a FASTA file and modifies headers with the specified rank names."""
-    rank_str = "_".join(rank_names.values()).replace(" ", "_")
-    print(f"Processing file '{os.path.basename(fasta_file)}' with ranks: {rank_str}")
-    
+    rank_str = rank_string(rank_names)
+
     # Format string for header lines with the rank as a variable
     header_format = ">{}_{}\n".format(rank_str, "{}")
 
-    with open(fasta_file, "r") as file:
+    with open_input(fasta_file, "rt") as file:
         while True:
             line = file.readline()
             if not line:
@@ -59,31 +98,115 @@ def modify_fasta_headers(fasta_file, rank_names):
             else:
                 yield line
 
-# Adjust the function to use buffered writing
-def add_ranks_to_fasta_headers(main_dir, out_dir, db_file, ranks):
+def copy_span(input_fd, output_fd, offset, length):
+    """Copies length bytes of the input from offset to the position of the output in the kernel,
+    with copy_file_range or sendfile. Returns False when neither can copy between these files."""
+    for kernel_copy in (
+        getattr(os, "copy_file_range", None),
+        lambda input_fd, output_fd, count, offset: os.sendfile(output_fd, input_fd, offset, count),
+    ):
+        if kernel_copy is None:
+            continue
+        try:
+            while length > 0:
+                copied = kernel_copy(input_fd, output_fd, length, offset)
+                if copied == 0:
+                    raise OSError(f"Unexpected end of file copying {length} bytes at {offset}")
+                offset += copied
+                length -= copied
+            return True
+        except OSError as error:
+            if error.errno not in KERNEL_COPY_ERRORS:
+                raise
+    return False
+
+def rewrite_fasta_headers(fasta_file, new_filepath, rank_names):
+    """Writes an uncompressed fasta file with modified headers, like modify_fasta_headers, returns False when it can not.
+
+    The header lines are found in a memory map of the file, only they are rewritten.
+    The sequence lines between them are written as they are, through a single output
+    buffer, and spans of KERNEL_COPY_SIZE or more are copied in the kernel. Files with
+    CR line ends are left to modify_fasta_headers, whose text mode turns them into LF.
+    """
+    header_format = ">{}_{}\n".format(rank_string(rank_names), "{}")
+    with open(fasta_file, "rb") as input_file, open(new_filepath, "wb", buffering=OUTPUT_BUFFER_SIZE) as output_file:
+        size = os.fstat(input_file.fileno()).st_size
+        if size == 0:
+            return True
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped.find(b"\r") != -1:
+                return False
+            view = memoryview(mapped)
+            find = mapped.find
+            write = output_file.write
+
+            def write_span(start, end):
+                if end - start >= KERNEL_COPY_SIZE:
+                    output_file.flush()
+                    if copy_span(input_file.fileno(), output_file.fileno(), start, end - start):
+                        return
+                write(view[start:end])
+
+            try:
+                # Lines before the first header are kept as they are
+                header_start = 0 if mapped[0] == ord(">") else find(b"\n>") + 1 or size
+                write_span(0, header_start)
+                while header_start < size:
+                    header_end = find(b"\n", header_start)
+                    header_end = size if header_end == -1 else header_end
+                    header = bytes(view[header_start:header_end]).decode().lstrip(">").strip()
+                    write(header_format.format(header).encode())
+
+                    # Sequence lines up to the next header line
+                    next_header = find(b"\n>", header_end)
+                    sequence_end = size if next_header == -1 else next_header + 1
+                    if sequence_end > header_end + 1:
+                        write_span(header_end + 1, sequence_end)
+                    header_start = sequence_end
+            finally:
+                view.release()
+    return True
+
+def add_ranks_to_fasta_headers(main_dir, out_dir, db_file, ranks, compress_output=False, incremental=False, taxonomy_backend="sqlite"):
     os.makedirs(out_dir, exist_ok=True)
-    db = TaxonomyDatabase(db_file)
+    # Both backends find the same rank names, the tree walks lineages over memory mapped arrays.
+    # A running taxonomy service already holds the tree, it is queried instead of either
+    db = connect_service(db_file)
+    if db is not None:
+        print("Using the running taxonomy service.")
+    elif taxonomy_backend == "tree":
+        db = TaxonomyTree.open(db_file)
+    else:
+        db = TaxonomyDatabase(db_file)
+    manifest = Manifest(out_dir, "add_taxonomy", {"ranks": ranks, "database": os.path.abspath(db_file), "database_version": database_signature(db_file)}, incremental)
 
     for file in os.listdir(main_dir):
+        if file.startswith("."):
+            continue  # hidden files such as fasta indexes and manifests
         filepath = os.path.join(main_dir, file)
         tax_id = extract_tax_id(file)
         
         if tax_id:
+            new_filepath = output_path(os.path.join(out_dir, file), compress_output)
+            input_paths = [filepath, db_file]
+            if manifest.is_up_to_date(file, input_paths, [new_filepath]):
+                print(f"Up to date: {file}")
+                continue
+
             rank_names = db.find_rank_names(tax_id, ranks[:])  # Pass a copy of ranks
-            new_filepath = os.path.join(out_dir, file)
-
-            buffer = []
-            for line in modify_fasta_headers(filepath, rank_names):
-                buffer.append(line)
-                
-                if len(buffer) >= 1000:
-                    with open(new_filepath, "a") as outfile:
-                        outfile.writelines(buffer)
-                    buffer = []
+            print(f"Processing file '{file}' with ranks: {rank_string(rank_names)}")
 
-            if buffer:
-                with open(new_filepath, "a") as outfile:
-                    outfile.writelines(buffer)
+            # Plain files only have their headers rewritten, the others are read and written line by line
+            if compress_output or is_compressed(filepath) or not rewrite_fasta_headers(filepath, new_filepath, rank_names):
+                with open_output(new_filepath) as outfile:
+                    buffer = []
+                    for line in modify_fasta_headers(filepath, rank_names):
+                        buffer.append(line)
+                        if len(buffer) >= 1000:
+                            outfile.write("".join(buffer))
+                            buffer = []
+                    outfile.write("".join(buffer))
+            manifest.record(file, input_paths, [new_filepath])
         else:
             print(f"[Warning] Tax ID not found in filename: {file}")
 
@@ -97,6 +220,9 @@ if __name__ == '__main__':
     parser.add_argument("-od", "--output_directory", help="Directory for output files", required=True)
     parser.add_argument("-db", "--database_file", help="Path to SQLite database file", required=True)
     parser.add_argument("-r", "--rank", help="Comma-separated list of taxonomic ranks to add.", required=True)
+    parser.add_argument("-co", "--compress_output", help="Write the output files compressed with bgzip (.gz)", required=False, default="False", choices=["True", "true", "False", "false"])
+    parser.add_argument("-inc", "--incremental", help="Skip input files whose outputs are up to date with the manifest of an earlier run", required=False, default="False", choices=["True", "true", "False", "false"])
+    parser.add_argument("-tb", "--taxonomy_backend", help="Walk lineages with SQLite queries or over the memory mapped tree snapshot of the database", required=False, default="sqlite", choices=["sqlite", "tree"])
     args = parser.parse_args()
 
     # Parse the ranks into a list and validate each rank
@@ -105,4 +231,4 @@ if __name__ == '__main__':
         print(f"[Error] Invalid ranks provided. Valid ranks are: {', '.join(valid_ranks)}")
         exit(1)
 
-    add_ranks_to_fasta_headers(args.input_directory, args.output_directory, args.database_file, ranks)
+    add_ranks_to_fasta_headers(args.input_directory, args.output_directory, args.database_file, ranks, args.compress_output.capitalize() == "True", args.incremental.capitalize() == "True", args.taxonomy_backend)
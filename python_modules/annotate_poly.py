@@ -1,93 +1,141 @@
 import argparse
+import contextlib
+import hashlib
 import os
-import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from compression import (
+    is_compressed,
+    open_output,
+    output_path,
+    strip_compression_suffix,
+)
+from fasta import Fasta
+from manifest import Manifest
+from poly_detector import batched, create_detectors, parse_amino_acids
+from translate import TRANSEQ_CACHE_MODE, transeq_title, translate_sequence_transeq
+from translation_cache import DEFAULT_MAX_SIZE, TranslationCache
+
+# The shard of a file read whole
+WHOLE_FILE = ((0, None), (0, None))
 
 
 def ensure_directory_exists(path):
     """Checks if directory exists, if not, creates it."""
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
 
 class Match:
-    """Defines a series of variables that contain information about the match sequence object."""
+    """Coordinates and breaks of one homorepeat, the strings are built when they are written."""
 
-    def __init__(self, match, amino_acid, fasta_id=str, fasta_seq=str) -> None:
-        self.match_object = match
+    __slots__ = ("start", "end", "breaks", "amino_acid", "fasta_id", "fasta_seq")
+
+    def __init__(self, start, end, breaks, amino_acid, fasta_id, fasta_seq):
+        self.start = start
+        self.end = end
+        self.breaks = breaks
+        self.amino_acid = amino_acid
         self.fasta_id = fasta_id
         self.fasta_seq = fasta_seq
-        self.length = match.span()[1] - match.span()[0]
-        self.sequence = match.group()
-        self.break_id, self.break_index = self.get_non_q_index(amino_acid)
-
-        if self.break_index:
-            after_break_size = int(self.length) - int(self.break_index)
-            self.match_break = f"{amino_acid}{int(self.break_index) - 1}{self.break_id}{amino_acid}{after_break_size}_{match.span()[0]}to{match.span()[1]}"
-        else:
-            self.match_break = (
-                f"{amino_acid}{self.length}_{match.span()[0]}to{match.span()[1]}"
-            )
 
-    def get_non_q_index(self, amino_acid):
-        """Returns index and character of a non-Q match if found"""
-        non_qmatch = re.search(f"[^{amino_acid}]", self.sequence)
-        if non_qmatch:
-            return non_qmatch.group(), str(non_qmatch.start() + 1)
-        return None, None
+    @property
+    def length(self):
+        return self.end - self.start
 
+    @property
+    def sequence(self):
+        return self.fasta_seq[self.start : self.end]
 
-class Fasta:
-    @staticmethod
-    def parse_generator(fasta_input_path):
-        """Simple fasta file reader"""
-        with open(fasta_input_path, "r") as file:
-            sequence_id = None
-            sequence_data = []
-
-            for line in file:
-                line = line.strip()
-                if line.startswith(">"):
-                    if sequence_id is not None:
-                        yield sequence_id, "".join(sequence_data)
-                    sequence_id = line
-                    sequence_data = []
-                else:
-                    sequence_data.append(line)
-            if sequence_id is not None:
-                yield sequence_id, "".join(sequence_data)  # Yield the last sequence
+    @property
+    def match_break(self):
+        return f"{self.format_breaks(self.amino_acid)}_{self.start}to{self.end}"
+
+    def format_breaks(self, amino_acid):
+        """Returns the residue counts around each break, e.g. Q4AQ3 for QQQQAQQQ."""
+        segments = []
+        previous = 0
+        for offset, break_id in self.breaks:
+            segments.append(f"{amino_acid}{offset - previous}{break_id}")
+            previous = offset + 1
+        segments.append(f"{amino_acid}{self.length - previous}")
+        return "".join(segments)
 
 
 class Poly:
-    """Handles the matching of polys and sorting them into different outputs."""
+    """Handles the matching of polys and sorting them into different outputs.
 
-    def __init__(self, input_dir, output_dir, input_basename, amino_acid):
+    Every record is read once and scanned with the detector of each residue.
+    Annotated sequences are remembered by their 16 byte digest, seen_digests
+    can be shared by the Poly of every file to annotate a sequence once per run.
+    """
 
-        self.amino_acid = amino_acid
+    def __init__(
+        self,
+        input_dir,
+        output_dir,
+        input_basename,
+        detectors,
+        compress_output=False,
+        single_pass=False,
+        translation_cache=None,
+        translation_cache_size=DEFAULT_MAX_SIZE,
+        seen_digests=None,
+    ):
+
+        self.detectors = detectors
+        self.single_pass = single_pass
+        self.translation_cache = translation_cache
+        self.translation_cache_size = translation_cache_size
+        self.seen_digests = set() if seen_digests is None else seen_digests
         self.fasta = Fasta()
-        self.protein_dir = os.path.join(args.output_directory, "translate_out")
+        self.protein_dir = os.path.join(output_dir, "translate_out")
         self.output_dir = output_dir
         self.protein_file_path = os.path.join(self.protein_dir, input_basename)
         self.input_dir = input_dir
         self.nucleotide_file_path = os.path.join(input_dir, input_basename)
+        output_name = os.path.splitext(strip_compression_suffix(input_basename))[0]
 
+        # Matches of a single residue keep the plain output names, several get a poly suffix each
         ensure_directory_exists(os.path.join(output_dir, "protein_matches"))
-        self.output_file_path = os.path.join(
-            output_dir, "protein_matches", f"{os.path.splitext(input_basename)[0]}"
-        )
+        ensure_directory_exists(os.path.join(output_dir, "nucleotide_matches"))
+        self.output_file_paths = {}
+        self.output_nucleotide_file_paths = {}
+        for amino_acid in detectors:
+            suffix = f"_poly{amino_acid}" if len(detectors) > 1 else ""
+            self.output_file_paths[amino_acid] = output_path(
+                os.path.join(output_dir, "protein_matches", f"{output_name}{suffix}"),
+                compress_output,
+            )
+            self.output_nucleotide_file_paths[amino_acid] = output_path(
+                os.path.join(
+                    output_dir, "nucleotide_matches", f"{output_name}{suffix}"
+                ),
+                compress_output,
+            )
 
         ensure_directory_exists(os.path.join(output_dir, "genome"))
-        self.output_genome_file_path = os.path.join(
-            output_dir, "genome", f"{os.path.splitext(input_basename)[0]}"
+        self.output_genome_file_path = output_path(
+            os.path.join(output_dir, "genome", output_name), compress_output
         )
 
-        ensure_directory_exists(os.path.join(output_dir, "nucleotide_matches"))
-        self.output_nucleotide_file_path = os.path.join(
-            output_dir, "nucleotide_matches", f"{os.path.splitext(input_basename)[0]}"
+    def input_paths(self):
+        if self.single_pass:
+            return [self.nucleotide_file_path]
+        return [self.protein_file_path, self.nucleotide_file_path]
+
+    def output_paths(self):
+        return (
+            list(self.output_file_paths.values())
+            + list(self.output_nucleotide_file_paths.values())
+            + [self.output_genome_file_path]
         )
 
-    def find_matches(self, pattern, header, sequence):
-        matches = pattern.finditer(sequence)
-        return [Match(match, self.amino_acid, header, sequence) for match in matches]
+    def find_matches(self, spans, amino_acid, header, sequence):
+        return [
+            Match(start, end, breaks, amino_acid, header, sequence)
+            for start, end, breaks in spans
+        ]
 
     @staticmethod
     def append_to_output(output_file, match, breaks, sequence):
@@ -96,55 +144,346 @@ class Poly:
             f"{match.fasta_id.strip()}_[poly={'_'.join(breaks)}]\n{sequence}\n"
         )
 
-    def process_lines(self):
-        """Processes lines in the data file, finds matches, and writes to report and output files."""
-        protein_generator = self.fasta.parse_generator(self.protein_file_path)
-        nucleotide_generator = self.fasta.parse_generator(self.nucleotide_file_path)
+    @contextlib.contextmanager
+    def open_translator(self):
+        """Yields a function translating a list of CDS like transeq, through the translation cache when one is set."""
+        if self.translation_cache is None:
+            yield lambda sequences: [
+                translate_sequence_transeq(sequence) for sequence in sequences
+            ]
+            return
+
+        with TranslationCache(
+            self.translation_cache,
+            TRANSEQ_CACHE_MODE,
+            translate_sequence_transeq,
+            self.translation_cache_size,
+        ) as cache:
+            yield cache.translate_batch
+            print(f"Translation cache: {cache.hits} hits, {cache.misses} misses")
+
+    def record_generator(self, shard=None):
+        """Yields (protein header, protein, nucleotide) for every record of the input.
+
+        In single pass mode each CDS is translated in memory with the header and
+        protein transeq -trim would give it, otherwise the translate_out protein file
+        is read alongside the nucleotide file.
+        A shard, as returned by plan_shards, limits the records to its byte ranges.
+        """
+        protein_range, nucleotide_range = shard or WHOLE_FILE
+        nucleotide_generator = self.fasta.parse_generator(
+            self.nucleotide_file_path, *nucleotide_range
+        )
+        if self.single_pass:
+            with self.open_translator() as translate_batch:
+                for batch in batched(nucleotide_generator):
+                    proteins = translate_batch(
+                        [nuc_sequence for _, nuc_sequence in batch]
+                    )
+                    for (nuc_id, nuc_sequence), prot_sequence in zip(batch, proteins):
+                        prot_id = f">{transeq_title(nuc_id[1:])}"
+                        yield prot_id, prot_sequence, nuc_sequence
+            return
+
+        protein_generator = self.fasta.parse_generator(
+            self.protein_file_path, *protein_range
+        )
         for (prot_id, prot_sequence), (nuc_id, nuc_sequence) in zip(
             protein_generator, nucleotide_generator
         ):
-            matches = self.find_matches(PATTERN, prot_id, prot_sequence)
-            appended = False
-            match_breaks = []
-            if matches:
-                if matches[0].fasta_seq not in seen_sequences:
-                    for match in matches:
-                        match_breaks.append(match.match_break)
-                        if not appended:
-                            seen_sequences.add(match.fasta_seq)
-                            appended = True
-                    # Appends only once for each sequence
-                    self.append_to_output(
-                        self.output_file, match, match_breaks, match.fasta_seq
-                    )
-                    self.append_to_output(
-                        self.output_genome_file, match, match_breaks, nuc_sequence
+            yield prot_id, prot_sequence, nuc_sequence
+
+    def match_generator(self, records):
+        """Yields the records with a dictionary of their matches for every residue that has any.
+
+        Detectors scan the proteins of a whole batch of records at once.
+        """
+        for batch in batched(records):
+            proteins = [prot_sequence for _, prot_sequence, _ in batch]
+            batch_spans = {
+                amino_acid: detector.find_batch(proteins)
+                for amino_acid, detector in self.detectors.items()
+            }
+
+            for index, (prot_id, prot_sequence, nuc_sequence) in enumerate(batch):
+                residue_matches = {}
+                for amino_acid, spans in batch_spans.items():
+                    matches = self.find_matches(
+                        spans[index], amino_acid, prot_id, prot_sequence
                     )
+                    if matches:
+                        residue_matches[amino_acid] = matches
+                yield prot_id, prot_sequence, nuc_sequence, residue_matches
+
+    @staticmethod
+    def sequence_digest(sequence):
+        return hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+
+    def process_lines(self, records=None, emitted=None):
+        """Processes lines in the data file, finds matches, and writes to report and output files.
+
+        When an emitted list is given, (genome entry index, sequence digest, matched residues)
+        is appended to it for every annotated sequence, in output order.
+        """
+        genome_entries = 0
+        for (
+            prot_id,
+            prot_sequence,
+            nuc_sequence,
+            residue_matches,
+        ) in self.match_generator(records or self.record_generator()):
+            if residue_matches:
+                digest = self.sequence_digest(prot_sequence)
+                if digest not in self.seen_digests:
+                    self.seen_digests.add(digest)
+                    # Appends only once for each sequence
+                    genome_breaks = []
+                    for amino_acid, matches in residue_matches.items():
+                        match_breaks = [match.match_break for match in matches]
+                        genome_breaks.extend(match_breaks)
+                        self.append_to_output(
+                            self.output_files[amino_acid],
+                            matches[-1],
+                            match_breaks,
+                            prot_sequence,
+                        )
+                        self.append_to_output(
+                            self.output_nucleotide_files[amino_acid],
+                            matches[-1],
+                            match_breaks,
+                            nuc_sequence,
+                        )
                     self.append_to_output(
-                        self.output_nucleotide_file, match, match_breaks, nuc_sequence
+                        self.output_genome_file, matches[-1], genome_breaks, nuc_sequence
                     )
+                    if emitted is not None:
+                        emitted.append(
+                            (genome_entries, digest, tuple(residue_matches))
+                        )
+                    genome_entries += 1
             else:
                 self.output_genome_file.write(f"{prot_id.strip()}\n{nuc_sequence}\n")
+                genome_entries += 1
 
-    def process_file(self):
-        with open(self.protein_file_path, "r") as data_file, open(
-            self.output_file_path, "w"
-        ) as self.output_file, open(
-            self.output_genome_file_path, "w"
-        ) as self.output_genome_file, open(
-            self.output_nucleotide_file_path, "w"
-        ) as self.output_nucleotide_file:
+    def open_files(self, stack, shard_index=None, mode="w"):
+        """Opens every output file on the ExitStack, or its part file when a shard index is given.
+
+        Part files are never compressed, the outputs are when their path ends in .gz.
+        """
 
+        def open_file(file_path):
+            if shard_index is None:
+                return stack.enter_context(open_output(file_path, mode))
+            part_path = self.part_path(file_path, shard_index)
+            return stack.enter_context(open(part_path, mode))
+
+        self.output_files = {
+            amino_acid: open_file(file_path)
+            for amino_acid, file_path in self.output_file_paths.items()
+        }
+        self.output_nucleotide_files = {
+            amino_acid: open_file(file_path)
+            for amino_acid, file_path in self.output_nucleotide_file_paths.items()
+        }
+        self.output_genome_file = open_file(self.output_genome_file_path)
+
+    def process_file(self):
+        with contextlib.ExitStack() as stack:
+            self.open_files(stack)
             self.process_lines()
 
+    def plan_shards(self, shard_size):
+        """Splits the input in shards of roughly shard_size bytes aligned on fasta records.
 
-if __name__ == "__main__":
+        Each shard is a (protein_range, nucleotide_range) tuple, None is returned
+        when the input is small enough to be processed whole or is compressed.
+        """
+        input_paths = self.input_paths()
+        if any(is_compressed(path) for path in input_paths):
+            return None  # gzip streams can not be split by byte range
+
+        shards = -(-os.path.getsize(input_paths[0]) // shard_size)
+        if shards < 2:
+            return None
+        if self.single_pass:
+            return [
+                ((0, None), nucleotide_range)
+                for nucleotide_range in self.fasta.shard_ranges(
+                    self.nucleotide_file_path, shards
+                )
+            ]
+        return self.fasta.paired_shard_ranges(
+            self.protein_file_path, self.nucleotide_file_path, shards
+        )
+
+    @staticmethod
+    def part_path(file_path, shard_index):
+        return f"{file_path}.part{shard_index}"
+
+    def process_shard(self, shard_index, shard):
+        """Scans one shard of the input into part files.
+
+        Sequences are only deduplicated inside the shard, the returned list of
+        annotated sequences lets merge_shards drop the rest.
+        """
+        emitted = []
+        with contextlib.ExitStack() as stack:
+            self.open_files(stack, shard_index)
+            self.process_lines(self.record_generator(shard), emitted)
+        return emitted
+
+    @staticmethod
+    def append_part(output_file, part_path, dropped_entries):
+        """Appends a part file to output_file, skipping the header and sequence entries in dropped_entries."""
+        with open(part_path, "rb") as part_file:
+            if not dropped_entries:
+                shutil.copyfileobj(part_file, output_file, 1 << 20)
+            else:
+                for entry_index, header in enumerate(part_file):
+                    sequence = part_file.readline()
+                    if entry_index not in dropped_entries:
+                        output_file.write(header)
+                        output_file.write(sequence)
+        os.remove(part_path)
+
+    def merge_shards(self, shard_results, seen_digests=None):
+        """Joins the part files of every shard in order, keeping only the first annotation of each sequence.
+
+        seen_digests holds the sequences annotated in earlier files when they are deduplicated per run.
+        """
+        seen_digests = set() if seen_digests is None else seen_digests
+        with contextlib.ExitStack() as stack:
+            self.open_files(stack, mode="wb")
 
-    def ensure_directory_exists(path):
-        """Checks if directory exists, if not, creates it."""
-        if not os.path.exists(path):
-            os.makedirs(path)
+            for shard_index, emitted in enumerate(shard_results):
+                dropped_genome_entries = set()
+                dropped_matches = {amino_acid: set() for amino_acid in self.detectors}
+                match_entries = dict.fromkeys(self.detectors, 0)
+                for genome_entry, digest, amino_acids in emitted:
+                    duplicate = digest in seen_digests
+                    seen_digests.add(digest)
+                    if duplicate:
+                        dropped_genome_entries.add(genome_entry)
+                    # Each residue file holds only the sequences that matched that residue
+                    for amino_acid in amino_acids:
+                        if duplicate:
+                            dropped_matches[amino_acid].add(match_entries[amino_acid])
+                        match_entries[amino_acid] += 1
 
+                outputs = [
+                    (
+                        self.output_genome_file,
+                        self.output_genome_file_path,
+                        dropped_genome_entries,
+                    )
+                ]
+                for amino_acid in self.detectors:
+                    outputs.append(
+                        (
+                            self.output_files[amino_acid],
+                            self.output_file_paths[amino_acid],
+                            dropped_matches[amino_acid],
+                        )
+                    )
+                    outputs.append(
+                        (
+                            self.output_nucleotide_files[amino_acid],
+                            self.output_nucleotide_file_paths[amino_acid],
+                            dropped_matches[amino_acid],
+                        )
+                    )
+                for output_file, file_path, dropped_entries in outputs:
+                    self.append_part(
+                        output_file,
+                        self.part_path(file_path, shard_index),
+                        dropped_entries,
+                    )
+
+
+def process_input_file(
+    input_dir,
+    output_dir,
+    input_basename,
+    detectors,
+    compress_output,
+    single_pass,
+    translation_cache,
+    translation_cache_size,
+    seen_digests=None,
+):
+    """Runs a Poly over one input file, used as the unit of work of the process pool."""
+    poly = Poly(
+        input_dir,
+        output_dir,
+        input_basename,
+        detectors,
+        compress_output,
+        single_pass,
+        translation_cache,
+        translation_cache_size,
+        seen_digests,
+    )
+    poly.process_file()
+    return input_basename
+
+
+def process_input_shard(poly_args, shard_index, shard):
+    """Runs a Poly over one shard of an input file, used as a unit of work of the process pool."""
+    return Poly(*poly_args).process_shard(shard_index, shard)
+
+
+def run_pool(executor, tasks, seen_digests=None, on_finished=None):
+    """Submits whole files and shards to the pool, sharded files are merged once all their shards finish.
+
+    With seen_digests sequences are deduplicated across files: every file is scanned
+    as shards and the files are merged in input order, sharing seen_digests.
+    on_finished is called with the basename of every file once its outputs are complete.
+    """
+    on_finished = on_finished or (lambda input_basename: None)
+    if seen_digests is not None:
+        tasks = [(poly_args, shards or [WHOLE_FILE]) for poly_args, shards in tasks]
+    next_merge = 0
+
+    futures = {}
+    shard_results = {}
+    for poly_args, shards in tasks:
+        if shards is None:
+            futures[executor.submit(process_input_file, *poly_args)] = (poly_args, None)
+            continue
+        shard_results[poly_args[2]] = [None] * len(shards)
+        for shard_index, shard in enumerate(shards):
+            future = executor.submit(process_input_shard, poly_args, shard_index, shard)
+            futures[future] = (poly_args, shard_index)
+
+    for future in as_completed(futures):
+        poly_args, shard_index = futures[future]
+        if shard_index is None:
+            print(f"Finished: {future.result()}")
+            on_finished(poly_args[2])
+            continue
+
+        results = shard_results[poly_args[2]]
+        results[shard_index] = future.result()
+        if seen_digests is None:
+            if all(result is not None for result in results):
+                Poly(*poly_args).merge_shards(results)
+                print(f"Finished: {poly_args[2]}")
+                on_finished(poly_args[2])
+            continue
+
+        # Merges every file whose shards are done, as long as the files before it are merged
+        while next_merge < len(tasks):
+            poly_args = tasks[next_merge][0]
+            results = shard_results[poly_args[2]]
+            if any(result is None for result in results):
+                break
+            Poly(*poly_args).merge_shards(results, seen_digests)
+            print(f"Finished: {poly_args[2]}")
+            on_finished(poly_args[2])
+            next_merge += 1
+
+
+if __name__ == "__main__":
     # Makes code usable by CLI
     parser = argparse.ArgumentParser(description="Protein poly identifier.")
     parser.add_argument(
@@ -159,7 +498,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-aa",
         "--poly_amino_acid",
-        help="The amino acid of chosen poly chain",
+        help="The amino acid of chosen poly chain, several residues (e.g. QAE) or ALL scan every one in a single pass",
         required=True,
     )
     parser.add_argument(
@@ -175,28 +514,180 @@ if __name__ == "__main__":
         required=True,
         default=True,
     )
+    parser.add_argument(
+        "-mb",
+        "--max_breaks",
+        help="Number of single aminoacid breaks allowed in a homorepeat, overrides --break_poly",
+        required=False,
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "-dt",
+        "--detector",
+        help="Homorepeat detector, a regular expression or a NumPy run-length scan",
+        required=False,
+        default="regex",
+        choices=["regex", "rle"],
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of input files processed in parallel",
+        required=False,
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "-ss",
+        "--shard_size",
+        help="Split input files bigger than this size in MB into shards scanned in parallel",
+        required=False,
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "-co",
+        "--compress_output",
+        help="Write the fasta outputs compressed with bgzip (.gz)",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-ds",
+        "--dedup_scope",
+        help="Annotate identical protein sequences once per file or once per run, the first file in name order keeps them",
+        required=False,
+        default="file",
+        choices=["file", "run"],
+    )
+    parser.add_argument(
+        "-inc",
+        "--incremental",
+        help="Skip input files whose outputs are up to date with the manifest of an earlier run",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-sp",
+        "--single_pass",
+        help="Translate the input CDS in memory like transeq -trim instead of reading translate_out",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-tc",
+        "--translation_cache",
+        help="SQLite file caching the proteins of translated CDS across runs, used in single pass mode",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "-tcs",
+        "--translation_cache_size",
+        help="Size in MB above which the least recently used proteins are evicted from the translation cache",
+        required=False,
+        default=DEFAULT_MAX_SIZE,
+        type=int,
+    )
     args = parser.parse_args()
+    single_pass = args.single_pass.capitalize() == "True"
+    compress_output = args.compress_output.capitalize() == "True"
+    incremental = args.incremental.capitalize() == "True"
 
-    if args.break_poly.capitalize() == "True":
-        PATTERN = re.compile(
-            r"{0}{{{1},}}([^{0}]{0}+)?".format(args.poly_amino_acid, args.size)
-        )
-    else:
-        PATTERN = re.compile(r"{0}{{{1},}}".format(args.poly_amino_acid, args.size))
+    max_breaks = args.max_breaks
+    if max_breaks is None:
+        max_breaks = 1 if args.break_poly.capitalize() == "True" else 0
+    DETECTORS = create_detectors(
+        parse_amino_acids(args.poly_amino_acid), args.size, max_breaks, args.detector
+    )
 
-    protein_dir = os.path.join(args.output_directory, "translate_out")
+    if single_pass:
+        listing_dir = args.input_directory
+    else:
+        listing_dir = os.path.join(args.output_directory, "translate_out")
     try:
-        input_filenames = os.listdir(protein_dir)
+        # Sorted, so the file keeping a sequence shared with others in run scope is the same on every filesystem
+        input_filenames = sorted(Fasta.list_files(listing_dir))
     except FileNotFoundError:
-        raise FileNotFoundError(f"Invalid input directory: {protein_dir}")
+        raise FileNotFoundError(f"Invalid input directory: {listing_dir}")
 
-    for input_basename in input_filenames:
-        print(f"File: {input_basename}")
-        poly = Poly(
+    params = {
+        "amino_acids": list(DETECTORS),
+        "size": int(args.size),
+        "max_breaks": max_breaks,
+        "compress_output": compress_output,
+        "dedup_scope": args.dedup_scope,
+        "single_pass": single_pass,
+    }
+    if args.dedup_scope == "run":
+        # The first file in name order keeps a shared sequence, so the listing is part of the run
+        params["input_files"] = input_filenames
+    manifest = Manifest(args.output_directory, "annotate_poly", params, incremental)
+
+    all_poly_args = {
+        input_basename: (
             args.input_directory,
             args.output_directory,
             input_basename,
-            args.poly_amino_acid,
+            DETECTORS,
+            compress_output,
+            single_pass,
+            args.translation_cache,
+            args.translation_cache_size,
         )
-        seen_sequences = set()  # Reset for each file
-        poly.process_file()
+        for input_basename in input_filenames
+    }
+    polys = {
+        input_basename: Poly(*poly_args)
+        for input_basename, poly_args in all_poly_args.items()
+    }
+    file_paths = {
+        input_basename: (poly.input_paths(), poly.output_paths())
+        for input_basename, poly in polys.items()
+    }
+    up_to_date = {
+        input_basename: manifest.is_up_to_date(input_basename, *paths)
+        for input_basename, paths in file_paths.items()
+    }
+    if args.dedup_scope == "run" and not all(up_to_date.values()):
+        # What a file annotates depends on the files before it, they are all processed again
+        up_to_date = dict.fromkeys(up_to_date, False)
+
+    # Each Poly keeps its own seen sequences, so they are reset for each file,
+    # unless they are deduplicated per run
+    seen_digests = set() if args.dedup_scope == "run" else None
+    tasks = []
+    for input_basename in input_filenames:
+        if up_to_date[input_basename]:
+            print(f"Up to date: {input_basename}")
+            continue
+        poly_args = all_poly_args[input_basename]
+        shards = None
+        if args.shard_size > 0:
+            shards = polys[input_basename].plan_shards(args.shard_size * 1024 * 1024)
+        tasks.append((poly_args, shards))
+
+    def record_finished(input_basename):
+        manifest.record(input_basename, *file_paths[input_basename])
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            run_pool(executor, tasks, seen_digests, record_finished)
+    else:
+        for poly_args, shards in tasks:
+            print(f"File: {poly_args[2]}")
+            if shards is None:
+                process_input_file(*poly_args, seen_digests)
+            else:
+                Poly(*poly_args).merge_shards(
+                    [
+                        process_input_shard(poly_args, shard_index, shard)
+                        for shard_index, shard in enumerate(shards)
+                    ],
+                    seen_digests,
+                )
+            record_finished(poly_args[2])
@@ -1,31 +1,205 @@
 import sqlite3
 import os
+import difflib
 import re
 import argparse
-import shutil  # Import shutil for file moving
+
+from compression import strip_compression_suffix
+from manifest import Manifest
+from placement import PLACEMENT_MODES, place_file
+from taxonomy_service import connect_service
+from taxonomy_tree import TaxonomyTree, database_signature
+
+# Tax IDs per query of a batch, below the SQLite limit of query parameters
+QUERY_CHUNK = 500
+
+# Decision of every input file, kept in the output directory
+DECISIONS_FILE = "decisions.tsv"
+DECISIONS_HEADER = ["file", "tax_id", "decision", "placement"]
+
+# Most names ranked by difflib when suggesting names for a misspelled taxon
+SUGGESTION_CANDIDATES = 10000
 
 class TaxonomyDatabase:
-    def __init__(self, db_file):
+    def __init__(self, db_file, taxonomy_backend="sqlite"):
         print("Loading database.")
         self.conn = sqlite3.connect(db_file)
         self.cursor = self.conn.cursor()
         self.wanted_tax_id = []
+        # Names are always looked up in the database, the tree only answers ancestry.
+        # A running taxonomy service answers it like the tree, whatever the backend
+        self.tree = connect_service(db_file)
+        if self.tree is not None:
+            print("Using the running taxonomy service.")
+        elif taxonomy_backend == "tree":
+            self.tree = TaxonomyTree.open(db_file)
+        # Nested set intervals of the wanted taxa, None when the database has no lineage table
+        self.wanted_intervals = None
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lineage'")
+        self.has_lineage = self.cursor.fetchone() is not None
+
+    def resolve_name(self, name):
+        """Returns the (tax_id, name_txt, name_class) of every name matching name.
+
+        Names of any class (scientific names, synonyms, common names...) match, when
+        none has the exact case of name the ones differing only in case are returned.
+        """
+        self.cursor.execute(
+            "SELECT tax_id, name_txt, name_class FROM names WHERE name_txt = ? COLLATE NOCASE",
+            (name,),
+        )
+        candidates = self.cursor.fetchall()
+        return [candidate for candidate in candidates if candidate[1] == name] or candidates
+
+    def suggest_names(self, name, limit=5):
+        """Returns the (name_txt, name_class) of the names closest to a misspelled name.
+
+        Candidates are the names starting like name, read through the NOCASE index
+        with the shortest prefix matching at most SUGGESTION_CANDIDATES names, then
+        ranked by difflib.
+        """
+        if not name:
+            return []
+        for prefix_length in range(1, len(name) + 1):
+            pattern = name[:prefix_length].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM names WHERE name_txt LIKE ? ESCAPE '\\' LIMIT ?)",
+                (pattern, SUGGESTION_CANDIDATES + 1),
+            )
+            if self.cursor.fetchone()[0] <= SUGGESTION_CANDIDATES:
+                break
+        self.cursor.execute(
+            "SELECT DISTINCT name_txt, name_class FROM names WHERE name_txt LIKE ? ESCAPE '\\' LIMIT ?",
+            (pattern, SUGGESTION_CANDIDATES),
+        )
+        candidates = self.cursor.fetchall()
+
+        classes = {}
+        for name_txt, name_class in candidates:
+            classes.setdefault(name_txt.lower(), (name_txt, name_class))
+        matches = difflib.get_close_matches(name.lower(), list(classes), n=limit, cutoff=0.6)
+        return [classes[match] for match in matches]
 
     def find_taxid(self, name):
-        self.cursor.execute("SELECT tax_id FROM names WHERE name_txt = ?", (name,))
-        results = self.cursor.fetchall()
-        if results:
-            self.wanted_tax_id = [row[0] for row in results]
+        candidates = self.resolve_name(name)
+        if candidates:
+            for tax_id, name_txt, name_class in candidates:
+                print(f"Found {name_txt} ({name_class}): {tax_id}")
+            self.wanted_tax_id = list(dict.fromkeys(candidate[0] for candidate in candidates))
             print(f"Found wanted_id: {self.wanted_tax_id}")
         else:
-            exit(f"No taxID found for {name}")
+            suggestions = ", ".join(f"{name_txt} ({name_class})" for name_txt, name_class in self.suggest_names(name))
+            exit(f"No taxID found for {name}" + (f", did you mean: {suggestions}?" if suggestions else ""))
+
+        if self.has_lineage:
+            self.wanted_intervals = [
+                interval
+                for interval in map(self.lineage_interval, self.wanted_tax_id)
+                if interval is not None
+            ]
+
+    def lineage_interval(self, tax_id):
+        self.cursor.execute("SELECT left_index, right_index FROM lineage WHERE tax_id = ?", (tax_id,))
+        return self.cursor.fetchone()
 
     def check_match(self, tax_id):
+        """Checks whether tax_id descends from one of the wanted taxa.
+
+        The tree backend and the lineage table compare nested set intervals,
+        otherwise the tree is walked up to the root with one query per ancestor.
+        """
         if tax_id is None:
             return False  # Handle case where tax_id is None
 
+        if self.tree is not None:
+            return bool(self.tree.descends_from([tax_id], self.wanted_tax_id)[0])
+
+        if self.wanted_intervals is not None:
+            interval = self.lineage_interval(tax_id)
+            if interval is not None:
+                left_index = interval[0]
+                return any(
+                    wanted_left < left_index <= wanted_right
+                    for wanted_left, wanted_right in self.wanted_intervals
+                )
+
+        return self.check_match_ancestors(tax_id)
+
+    def check_matches(self, tax_ids):
+        """Checks a batch of tax IDs at once, returns {tax_id: whether it descends from one of the wanted taxa}.
+
+        Every distinct tax ID is resolved once, with the same result as check_match:
+        over the tree with the tree backend, by reading the intervals of QUERY_CHUNK tax
+        IDs per query from the lineage table, and for the remaining ones (databases
+        without the lineage table) with a recursive query walking their lineages together.
+        """
+        tax_ids = [tax_id for tax_id in dict.fromkeys(tax_ids) if tax_id is not None]
+        matches = {}
+        if self.tree is not None:
+            descends = self.tree.descends_from(tax_ids, self.wanted_tax_id).tolist()
+            return dict(zip(tax_ids, descends))
+
+        remaining = tax_ids
+        if self.wanted_intervals is not None:
+            left_indices = self.lineage_left_indices(tax_ids)
+            remaining = []
+            for tax_id in tax_ids:
+                left_index = left_indices.get(int(tax_id))
+                if left_index is None:
+                    remaining.append(tax_id)
+                else:
+                    matches[tax_id] = any(
+                        wanted_left < left_index <= wanted_right
+                        for wanted_left, wanted_right in self.wanted_intervals
+                    )
+
+        descendants = self.wanted_descendants(remaining)
+        matches.update((tax_id, int(tax_id) in descendants) for tax_id in remaining)
+        return matches
+
+    def lineage_left_indices(self, tax_ids):
+        """Returns {tax_id: left_index} of the tax IDs in the lineage table."""
+        tax_ids = [int(tax_id) for tax_id in tax_ids]
+        left_indices = {}
+        for start in range(0, len(tax_ids), QUERY_CHUNK):
+            chunk = tax_ids[start : start + QUERY_CHUNK]
+            self.cursor.execute(
+                f"SELECT tax_id, left_index FROM lineage WHERE tax_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            left_indices.update(self.cursor.fetchall())
+        return left_indices
+
+    def wanted_descendants(self, tax_ids):
+        """Returns the tax IDs with one of the wanted taxa among their ancestors, walking every lineage in one recursive query per chunk."""
+        tax_ids = [int(tax_id) for tax_id in tax_ids]
+        wanted = list(self.wanted_tax_id)
+        descendants = set()
+        for start in range(0, len(tax_ids), QUERY_CHUNK):
+            chunk = tax_ids[start : start + QUERY_CHUNK]
+            # UNION drops repeated (tax_id, ancestor) pairs, so a cycle in the nodes ends the walk
+            self.cursor.execute(
+                f"""
+                WITH RECURSIVE walk (tax_id, ancestor) AS (
+                    SELECT tax_id, parent_tax_id FROM nodes WHERE tax_id IN ({', '.join('?' * len(chunk))})
+                    UNION
+                    SELECT walk.tax_id, nodes.parent_tax_id FROM walk
+                    JOIN nodes ON nodes.tax_id = walk.ancestor
+                    WHERE nodes.parent_tax_id != nodes.tax_id
+                )
+                SELECT DISTINCT tax_id FROM walk WHERE ancestor IN ({', '.join('?' * len(wanted))})
+                """,
+                chunk + wanted,
+            )
+            descendants.update(row[0] for row in self.cursor.fetchall())
+        return descendants
+
+    def check_match_ancestors(self, tax_id):
+        """Walks up the tree from tax_id with one query per ancestor."""
         current_tax_id = tax_id
-        while current_tax_id:
+        visited = set()
+        while current_tax_id and current_tax_id not in visited:
+            visited.add(current_tax_id)
             self.cursor.execute("SELECT parent_tax_id FROM nodes WHERE tax_id = ?", (current_tax_id,))
             result = self.cursor.fetchone()
             
@@ -36,24 +210,55 @@ class TaxonomyDatabase:
                 current_tax_id = parent_tax_id
             else:
                 return False
-        return False
+        return False  # reached the root, which is its own parent in the NCBI dump
 
 class FileManagment:
-    def __init__(self, input_path, output_path, contaminated_path):
+    def __init__(self, input_path, output_path, contaminated_path, placement="copy"):
         self.search_pattern = r'_(\d+)(?:\.[^.]+)?$'
         self.input_path = input_path
         self.output_path = output_path
         self.contaminated_path = contaminated_path
+        # Files are copied, or linked to the input files, see place_file
+        self.placement = placement
 
     def extract_tax_id(self, file_name):
-        match = re.search(self.search_pattern, file_name)
+        match = re.search(self.search_pattern, strip_compression_suffix(file_name))
         return match.group(1) if match else None
     
     def move_to_output(self, file_name):
-        shutil.copy(os.path.join(self.input_path, file_name), os.path.join(self.output_path, file_name))
+        """Places the file in the output folder, returns its path and how it was placed."""
+        self.remove_copy(self.contaminated_path, file_name)
+        path = os.path.join(self.output_path, file_name)
+        return path, place_file(os.path.join(self.input_path, file_name), path, self.placement)
 
     def move_to_contaminated(self, file_name):
-        shutil.copy(os.path.join(self.input_path, file_name), os.path.join(self.contaminated_path, file_name))
+        """Places the file in the contamination folder, returns its path and how it was placed."""
+        self.remove_copy(self.output_path, file_name)
+        path = os.path.join(self.contaminated_path, file_name)
+        return path, place_file(os.path.join(self.input_path, file_name), path, self.placement)
+
+    @staticmethod
+    def remove_copy(directory, file_name):
+        """Removes the copy or link of an earlier run that classified the file the other way."""
+        file_path = os.path.join(directory, file_name)
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+
+def load_decisions(path):
+    """Returns {file: row} of a decisions file, empty when there is none."""
+    try:
+        with open(path, "r") as decisions_file:
+            rows = [line.rstrip("\n").split("\t") for line in decisions_file]
+    except OSError:
+        return {}
+    return {row[0]: row for row in rows[1:] if len(row) == len(DECISIONS_HEADER)}
+
+def save_decisions(path, decisions):
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as decisions_file:
+        for row in [DECISIONS_HEADER] + [decisions[file] for file in sorted(decisions)]:
+            decisions_file.write("\t".join(row) + "\n")
+    os.replace(temporary_path, path)
 
 if __name__ == '__main__':
     # CLI argument parser setup
@@ -62,19 +267,51 @@ if __name__ == '__main__':
     parser.add_argument("-od", "--output_directory", help="Directory for output files", required=True)
     parser.add_argument("-db", "--database_file", help="Path to SQLite database file", required=True)
     parser.add_argument("-tn", "--taxonomy_name", help="Taxonomy rank name string.", required=True)
+    parser.add_argument("-inc", "--incremental", help="Skip input files whose outputs are up to date with the manifest of an earlier run", required=False, default="False", choices=["True", "true", "False", "false"])
+    parser.add_argument("-tb", "--taxonomy_backend", help="Check ancestry with SQLite queries or over the memory mapped tree snapshot of the database", required=False, default="sqlite", choices=["sqlite", "tree"])
+    parser.add_argument("-pm", "--placement", help="Copy the classified files, or hardlink, reflink or symlink them to the input files (hardlinks and reflinks are copied when not possible)", required=False, default="copy", choices=PLACEMENT_MODES)
     args = parser.parse_args()
 
-    taxonomy_manager = TaxonomyDatabase(args.database_file)
-    file_manager = FileManagment(args.input_directory, os.path.join(args.output_directory, "passed"), os.path.join(args.output_directory, "contamination"))
+    taxonomy_manager = TaxonomyDatabase(args.database_file, args.taxonomy_backend)
+    file_manager = FileManagment(args.input_directory, os.path.join(args.output_directory, "passed"), os.path.join(args.output_directory, "contamination"), args.placement)
     
-    taxonomy_manager.find_taxid(args.taxonomy_name.capitalize())
+    taxonomy_manager.find_taxid(args.taxonomy_name)
+    # Keyed on the taxa the name resolved to, names differing in case can resolve to different ones
+    manifest = Manifest(args.output_directory, "check_contamination", {"wanted_tax_ids": taxonomy_manager.wanted_tax_id, "database": os.path.abspath(args.database_file), "database_version": database_signature(args.database_file)}, args.incremental.capitalize() == "True")
     
+    # Decisions of files up to date with an earlier run are kept, the ones of files no longer in the input dropped
+    decisions_path = os.path.join(args.output_directory, DECISIONS_FILE)
+    earlier_decisions = load_decisions(decisions_path)
+    decisions = {}
+
+    pending_files = []
     for file in os.listdir(args.input_directory):
+        if file.startswith("."):
+            continue  # hidden files such as fasta indexes
         file_name = os.path.basename(file)
-        tax_id = file_manager.extract_tax_id(file_name=file_name)
+        if file_name in earlier_decisions:
+            decisions[file_name] = earlier_decisions[file_name]
+        input_paths = [os.path.join(args.input_directory, file_name), args.database_file]
+        # The output folder depends on the classification, the recorded copy is checked
+        if manifest.is_up_to_date(file_name, input_paths):
+            print(f"Up to date: {file_name}")
+            continue
+        pending_files.append((file_name, input_paths, file_manager.extract_tax_id(file_name=file_name)))
+
+    # Assemblies of the same taxon share a tax ID, each distinct one is checked once
+    matches = taxonomy_manager.check_matches(tax_id for _, _, tax_id in pending_files)
+    print(f"Classifying {len(pending_files)} files of {len(matches)} distinct tax IDs.")
 
-        if taxonomy_manager.check_match(tax_id=tax_id):
-            file_manager.move_to_output(file_name=file_name)
+    for file_name, input_paths, tax_id in pending_files:
+        if matches.get(tax_id, False):
+            copy_path, placed = file_manager.move_to_output(file_name=file_name)
+            decision = "passed"
         else:
             print(f"File {file_name} is contamination.")
-            file_manager.move_to_contaminated(file_name=file_name)
+            copy_path, placed = file_manager.move_to_contaminated(file_name=file_name)
+            decision = "contamination"
+        decisions[file_name] = [file_name, tax_id or "", decision, placed]
+        # Saved with the manifest entry, an interrupted run keeps the decisions of the files it placed
+        save_decisions(decisions_path, decisions)
+        manifest.record(file_name, input_paths, [copy_path])
+    save_decisions(decisions_path, decisions)
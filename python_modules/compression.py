@@ -0,0 +1,99 @@
+import gzip
+import io
+import os
+import shutil
+import subprocess
+
+from Bio.bgzf import BgzfWriter
+
+try:
+    # python-isal inflates gzip several times faster than zlib
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+COMPRESSED_SUFFIXES = (".gz", ".bgz")
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Threads given to bgzip to inflate the blocks of a bgzip file in parallel
+DECOMPRESSION_THREADS = min(os.cpu_count() or 1, 4)
+
+
+def is_compressed(path):
+    """Checks the gzip magic bytes, bgzip files are gzip files too."""
+    with open(path, "rb") as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def strip_compression_suffix(path):
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def output_path(path, compress):
+    """Returns path without its compression suffix, with .gz added back for a compressed output."""
+    path = strip_compression_suffix(path)
+    return f"{path}.gz" if compress else path
+
+
+def resolve_path(path):
+    """Returns path, or its compressed or uncompressed variant when only that one exists."""
+    if os.path.exists(path):
+        return path
+    for candidate in [strip_compression_suffix(path)] + [
+        f"{path}{suffix}" for suffix in COMPRESSED_SUFFIXES
+    ]:
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+
+class BgzipReader(io.BufferedReader):
+    """Streams a gzip file decompressed by bgzip in a subprocess.
+
+    bgzip -@ inflates the blocks of bgzip files in parallel, plain gzip files
+    are read with a single thread.
+    """
+
+    def __init__(self, path, threads=DECOMPRESSION_THREADS):
+        self.path = path
+        self.process = subprocess.Popen(
+            ["bgzip", "-d", "-c", "-@", str(threads), path],
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        super().__init__(self.process.stdout, 1 << 20)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        # A negative code is the SIGPIPE of a file closed before its end
+        if self.process.wait() > 0:
+            raise OSError(f"bgzip could not decompress {self.path}")
+
+
+def open_input(path, mode="rb"):
+    """Opens a plain, gzip or bgzip file for reading, mode is "rb" or "rt"."""
+    if not is_compressed(path):
+        return open(path, mode)
+
+    if shutil.which("bgzip"):
+        file = BgzipReader(path)
+    elif igzip is not None:
+        file = igzip.open(path, "rb")
+    else:
+        file = gzip.open(path, "rb")
+    return io.TextIOWrapper(file) if "t" in mode else file
+
+
+def open_output(path, mode="w"):
+    """Opens a file for writing, paths ending in .gz are compressed as bgzip.
+
+    bgzip files are read by any gzip reader and can be decompressed in parallel.
+    """
+    if path.endswith(COMPRESSED_SUFFIXES):
+        return BgzfWriter(path, mode)
+    return open(path, mode)
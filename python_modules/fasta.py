@@ -0,0 +1,382 @@
+import mmap
+import os
+import re
+
+from compression import GZIP_MAGIC, is_compressed, open_input
+
+GENE_ID_PATTERN = re.compile(rb"GeneID:(\d+)")
+
+# Whitespace bytes.strip() removes besides line feeds, sequence lines with any are stripped one by one
+LINE_WHITESPACE = b" \t\r\x0b\x0c"
+
+
+class FastaRecord:
+    """A record of a memory-mapped fasta file.
+
+    header (with the leading >) and raw_sequence (with the line breaks of the file)
+    are zero-copy memoryviews of the file, they are only valid while it is open.
+    """
+
+    __slots__ = ("offset", "header", "raw_sequence")
+
+    def __init__(self, offset, header, raw_sequence):
+        self.offset = offset
+        self.header = header
+        self.raw_sequence = raw_sequence
+
+    def header_text(self):
+        return bytes(self.header).decode().strip()
+
+    def sequence(self):
+        """Returns the sequence as bytes, every line stripped of surrounding whitespace like the line readers do."""
+        sequence = bytes(self.raw_sequence)
+        if len(sequence.translate(None, LINE_WHITESPACE)) == len(sequence):
+            return sequence.replace(b"\n", b"")  # only line breaks to remove
+        return b"".join(line.strip() for line in sequence.split(b"\n"))
+
+    def accession(self):
+        fields = bytes(self.header[1:]).split(None, 1)
+        return fields[0].decode() if fields else ""
+
+    def gene_id(self):
+        match = GENE_ID_PATTERN.search(self.header)
+        return match.group(1).decode() if match else ""
+
+
+class IndexedFasta:
+    """Memory-mapped fasta file with random access by accession or GeneID.
+
+    The index holds the offset, length, accession and GeneID of every record, it is
+    built on the first lookup. With persist_index it is cached next to the file as
+    .<name>.fxi, the cache is rebuilt whenever the size or modification time of the
+    file changes, otherwise it is only kept in memory.
+    Compressed files can not be mapped, see StreamedFasta.
+    """
+
+    INDEX_VERSION = "1"
+
+    def __init__(self, fasta_input_path, persist_index=True):
+        self.path = fasta_input_path
+        self.persist_index = persist_index
+        self.file = open(fasta_input_path, "rb")
+        stat = os.fstat(self.file.fileno())
+        self.stamp = f"{stat.st_size}\t{stat.st_mtime_ns}"
+        # mmap can not map an empty file
+        self.data = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size
+            else b""
+        )
+        if self.data[:2] == GZIP_MAGIC:
+            self.close()
+            raise ValueError(
+                f"{fasta_input_path} is compressed, it can not be memory-mapped"
+            )
+        self.view = memoryview(self.data)
+        self.index = None
+        self.accessions = None
+        self.gene_ids = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if hasattr(self, "view"):
+            self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass  # records still in use, the map is released with them
+        self.file.close()
+
+    @staticmethod
+    def index_path(fasta_input_path):
+        directory, file_name = os.path.split(fasta_input_path)
+        return os.path.join(directory, f".{file_name}.fxi")
+
+    def first_record(self, start=0):
+        """Returns the offset of the first record at or after start, -1 if there is none."""
+        if self.data[start : start + 1] == b">" and (
+            start == 0 or self.data[start - 1] == 10
+        ):
+            return start
+        return self.next_record(start)
+
+    def next_record(self, position):
+        """Returns the offset of the first record after position, -1 if there is none."""
+        # ">" is far less common than line breaks, so it is the faster one to search
+        while True:
+            position = self.data.find(b">", position + 1)
+            if position == -1 or self.data[position - 1] == 10:
+                return position
+
+    def record_at(self, offset, end=None):
+        """Returns the record starting at offset, it ends on the next record when end is not given."""
+        size = len(self.data)
+        header_end = self.data.find(b"\n", offset, size if end is None else end)
+        if header_end == -1:
+            header_end = size if end is None else end
+        if end is None:
+            next_record = self.next_record(header_end)
+            end = size if next_record == -1 else next_record
+        return FastaRecord(
+            offset,
+            self.view[offset:header_end],
+            self.view[min(header_end + 1, end) : end],
+        )
+
+    def read(self, offset):
+        """Returns the (header, sequence) text of the record at offset."""
+        record = self.record_at(offset)
+        return record.header_text(), record.sequence().decode()
+
+    def records(self, start=0, end=None):
+        """Yields every record starting in the byte range [start, end)."""
+        end = len(self.data) if end is None else end
+        offset = self.first_record(start)
+        while offset != -1 and offset < end:
+            record = self.record_at(offset)
+            yield record
+            offset = record.offset + len(record.header) + 1 + len(record.raw_sequence)
+
+    def record_offsets(self):
+        """Yields the byte offset of every record."""
+        offset = self.first_record()
+        while offset != -1:
+            yield offset
+            offset = self.next_record(offset)
+
+    def build_index(self):
+        index = []
+        for record in self.records():
+            length = len(record.header) + 1 + len(record.raw_sequence)
+            index.append((record.offset, length, record.accession(), record.gene_id()))
+        return index
+
+    def read_index(self):
+        """Returns the cached index, None if it is missing or out of date."""
+        try:
+            with open(self.index_path(self.path), "r") as index_file:
+                if index_file.readline() != f"fxi\t{self.INDEX_VERSION}\t{self.stamp}\n":
+                    return None
+                index = []
+                for line in index_file:
+                    offset, length, accession, gene_id = line.rstrip("\n").split("\t")
+                    index.append((int(offset), int(length), accession, gene_id))
+                return index
+        except (OSError, ValueError):
+            return None
+
+    def write_index(self, index):
+        index_path = self.index_path(self.path)
+        temporary_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "w") as index_file:
+                index_file.write(f"fxi\t{self.INDEX_VERSION}\t{self.stamp}\n")
+                for entry in index:
+                    index_file.write("\t".join(str(field) for field in entry) + "\n")
+            os.replace(temporary_path, index_path)
+        except OSError:
+            pass  # read-only directory, the index is only kept in memory
+
+    def load_index(self):
+        if self.index is None:
+            index = self.read_index()
+            if index is None:
+                index = self.build_index()
+                if self.persist_index:
+                    self.write_index(index)
+            self.index = index
+            self.accessions = {}
+            self.gene_ids = {}
+            for entry in index:
+                self.accessions.setdefault(entry[2], entry)
+                if entry[3]:
+                    self.gene_ids.setdefault(entry[3], []).append(entry)
+        return self.index
+
+    def get(self, accession):
+        """Returns the record of an accession (first word of the header), None when missing."""
+        self.load_index()
+        entry = self.accessions.get(accession)
+        if entry is None:
+            return None
+        return self.record_at(entry[0], entry[0] + entry[1])
+
+    def get_gene(self, gene_id):
+        """Returns every record (isoform) of a GeneID."""
+        self.load_index()
+        return [
+            self.record_at(offset, offset + length)
+            for offset, length, _, _ in self.gene_ids.get(str(gene_id), [])
+        ]
+
+
+class StreamedFasta:
+    """Reads records of a compressed fasta file by offset, like IndexedFasta.read.
+
+    The records at the wanted (uncompressed) offsets are collected in one pass over the file.
+    """
+
+    def __init__(self, fasta_input_path, offsets):
+        wanted = set(offsets)
+        self.records = {}
+        for offset, header, sequence in Fasta.stream_offset_generator(
+            fasta_input_path
+        ):
+            if offset in wanted:
+                self.records[offset] = (header, sequence)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.records = {}
+
+    def read(self, offset):
+        return self.records[offset]
+
+
+class Fasta:
+    @staticmethod
+    def list_files(directory):
+        """Lists the fasta files of a directory, skipping hidden files such as the .fxi indexes."""
+        return [
+            file_name
+            for file_name in os.listdir(directory)
+            if not file_name.startswith(".")
+        ]
+
+    @staticmethod
+    def parse_generator(fasta_input_path, start=0, end=None):
+        """Simple fasta file reader, limited to the byte range [start, end) when given."""
+        for _, header, sequence in Fasta.parse_offset_generator(
+            fasta_input_path, start, end
+        ):
+            yield header, sequence
+
+    @staticmethod
+    def parse_offset_generator(fasta_input_path, start=0, end=None):
+        """Same as parse_generator, yielding the byte offset of each record first.
+
+        Compressed files are streamed whole and the offsets count uncompressed bytes.
+        """
+        if is_compressed(fasta_input_path):
+            if start != 0 or end is not None:
+                raise ValueError(
+                    f"{fasta_input_path} is compressed, it can not be read by range"
+                )
+            yield from Fasta.stream_offset_generator(fasta_input_path)
+            return
+
+        with IndexedFasta(fasta_input_path, persist_index=False) as fasta:
+            for record in fasta.records(start, end):
+                yield record.offset, record.header_text(), record.sequence().decode()
+
+    @staticmethod
+    def stream_offset_generator(fasta_input_path):
+        """Line by line reader of parse_offset_generator, used for compressed files."""
+        with open_input(fasta_input_path) as file:
+            position = 0
+            record = None
+            sequence_data = []
+
+            for line in file:
+                offset = position
+                position += len(line)
+                if line.startswith(b">"):
+                    if record is not None:
+                        yield (*record, b"".join(sequence_data).decode())
+                    record = (offset, line.decode().strip())
+                    sequence_data = []
+                elif record is not None:
+                    sequence_data.append(line.strip())
+            if record is not None:
+                yield (*record, b"".join(sequence_data).decode())
+
+    @staticmethod
+    def header_generator(fasta_input_path):
+        """Yields the header of every record without decoding the sequences."""
+        if is_compressed(fasta_input_path):
+            for _, header, _ in Fasta.stream_offset_generator(fasta_input_path):
+                yield header
+            return
+
+        with IndexedFasta(fasta_input_path, persist_index=False) as fasta:
+            for record in fasta.records():
+                yield record.header_text()
+
+    @staticmethod
+    def record_offsets(fasta_input_path):
+        """Yields the byte offset of every record."""
+        if is_compressed(fasta_input_path):
+            for offset, _, _ in Fasta.stream_offset_generator(fasta_input_path):
+                yield offset
+            return
+
+        with IndexedFasta(fasta_input_path, persist_index=False) as fasta:
+            yield from fasta.record_offsets()
+
+    @staticmethod
+    def open_reader(fasta_input_path, offsets):
+        """Opens a reader of the records at offsets, memory-mapped unless the file is compressed."""
+        if is_compressed(fasta_input_path):
+            return StreamedFasta(fasta_input_path, offsets)
+        return IndexedFasta(fasta_input_path, persist_index=False)
+
+    @staticmethod
+    def shard_ranges(fasta_input_path, shards):
+        """Splits a fasta file in up to `shards` byte ranges, each one starting on a record."""
+        file_size = os.path.getsize(fasta_input_path)
+        boundaries = [0]
+
+        with open(fasta_input_path, "rb") as file:
+            for shard in range(1, shards):
+                # Moves to the first line starting at or after the even split point
+                file.seek(max(shard * file_size // shards - 1, 0))
+                file.readline()
+                boundary = file.tell()
+                line = file.readline()
+                while line and not line.startswith(b">"):
+                    boundary = file.tell()
+                    line = file.readline()
+                if boundaries[-1] < boundary < file_size:
+                    boundaries.append(boundary)
+
+        boundaries.append(file_size)
+        return list(zip(boundaries, boundaries[1:]))
+
+    @staticmethod
+    def paired_shard_ranges(fasta_input_path, paired_input_path, shards):
+        """Shards two fasta files that hold the same records in the same order.
+
+        Returns a list of (range, paired_range) tuples covering the same records in each file.
+        """
+        ranges = Fasta.shard_ranges(fasta_input_path, shards)
+        boundaries = {start for start, _ in ranges[1:]}
+        ordinals = {
+            ordinal
+            for ordinal, offset in enumerate(Fasta.record_offsets(fasta_input_path))
+            if offset in boundaries
+        }
+
+        paired_size = os.path.getsize(paired_input_path)
+        paired_boundaries = [0]
+        paired_boundaries.extend(
+            offset
+            for ordinal, offset in enumerate(Fasta.record_offsets(paired_input_path))
+            if ordinal in ordinals
+        )
+        # A shorter paired file leaves its trailing ranges empty, as zip() would
+        while len(paired_boundaries) < len(ranges):
+            paired_boundaries.append(paired_size)
+        paired_boundaries.append(paired_size)
+
+        return list(zip(ranges, zip(paired_boundaries, paired_boundaries[1:])))
@@ -1,8 +1,26 @@
 import argparse
+import contextlib
 import os
 import re
 import csv
+import shutil
 import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from compression import (
+    is_compressed,
+    open_output,
+    output_path,
+    strip_compression_suffix,
+)
+from fasta import Fasta
+from manifest import Manifest
+from poly_detector import batched, create_detectors, parse_amino_acids
+from poly_report import SqliteReport
+from translate import CACHE_MODE, translate_sequence
+from translation_cache import DEFAULT_MAX_SIZE, TranslationCache
 
 
 def setup_logging(log_file="logfile.log"):
@@ -14,43 +32,38 @@ def setup_logging(log_file="logfile.log"):
     )
 
 
+def setup_worker_logging(log_queue):
+    """Routes the log records of a worker process to the listener in the parent process."""
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+
+
 def log(message):
     logging.info(message)
 
 
-class Match:
-    """Defines a series of variables that contain information about the match sequence object."""
+def ensure_directory_exists(path):
+    """Checks if directory exists, if not, creates it."""
+    os.makedirs(path, exist_ok=True)
 
-    def __init__(
-        self, match, amino_acid, fasta_id=str, fasta_seq=str, nucsequence=str
-    ) -> None:
-        self.match_object = match
+
+class Record:
+    """Header fields of a fasta record, parsed once and shared by all of its matches."""
+
+    __slots__ = ("fasta_id", "fasta_seq", "nucsequence", "name", "geneid")
+
+    PROTEIN_NAME_PATTERN = re.compile(r"\[protein=([^\]]+)\]")
+    GENE_ID_PATTERN = re.compile(r"GeneID:(\d+)")
+
+    def __init__(self, fasta_id, fasta_seq, nucsequence):
         self.fasta_id = fasta_id
         self.fasta_seq = fasta_seq
-        self.length = match.span()[1] - match.span()[0]
-        self.sequence = match.group()
-        self.break_id, self.break_index = self.get_non_q_index(amino_acid)
         self.nucsequence = nucsequence
 
-        # handles break formatting
-        if self.break_index:
-            after_break_size = int(self.length) - int(self.break_index)
-            self.match_break = f"{amino_acid}{int(self.break_index) - 1}{self.break_id}{amino_acid}{after_break_size}_{match.span()[0]}to{match.span()[1]}"
-        else:
-            self.match_break = (
-                f"{amino_acid}{self.length}_{match.span()[0]}to{match.span()[1]}"
-            )
-
         # handles name
-        try:
-            acession_pattern = r"\[protein=([^\]]+)\]"
-            acession_match = re.search(acession_pattern, fasta_id)
-            if acession_match:
-                self.name = acession_match.group(1)
-            else:
-                self.name = "None"
-        except AttributeError:
-            self.name = "None"
+        name_match = self.PROTEIN_NAME_PATTERN.search(fasta_id)
+        self.name = name_match.group(1) if name_match else "None"
 
         # tries to find gene ID, if not found, stops the script.
         self.geneid = self.find_gene_id(fasta_id)
@@ -59,203 +72,635 @@ class Match:
                 f"{fasta_id} has no GeneID, cannot continue, exiting the script."
             )
 
-    def get_non_q_index(self, amino_acid):
-        """Returns index and character of a non-Q match if found"""
-        non_qmatch = re.search(f"[^{amino_acid}]", self.sequence)
-        if non_qmatch:
-            return non_qmatch.group(), str(non_qmatch.start() + 1)
-        return None, None
-
-    @staticmethod
-    def find_gene_id(sequence_data):
-        geneid_pattern = r"GeneID:(\d+)"
-        match = re.search(geneid_pattern, sequence_data)
+    @classmethod
+    def find_gene_id(cls, sequence_data):
+        match = cls.GENE_ID_PATTERN.search(sequence_data)
         return match.group(1) if match else None
 
 
-class Fasta:
-    @staticmethod
-    def parse_generator(fasta_input_path):
-        """simple fasta file reader"""
-        with open(fasta_input_path, "r") as file:
-            sequence_id = None
-            sequence_data = []
-
-            for line in file:
-                line = line.strip()
-                if line.startswith(">"):
-                    if sequence_id is not None:
-                        yield sequence_id, "".join(sequence_data)
-                    sequence_id = line
-                    sequence_data = []
-                else:
-                    sequence_data.append(line)
-            if sequence_id is not None:
-                yield sequence_id, "".join(sequence_data)  # Yield the last sequence
+class Match:
+    """Coordinates and breaks of one homorepeat, the strings are built when they are written."""
 
+    __slots__ = ("start", "end", "breaks", "amino_acid", "record")
 
-class Poly:
-    """Handles the matching of polys and sorting them into diferent outputs."""
+    def __init__(self, start, end, breaks, amino_acid, record):
+        self.start = start
+        self.end = end
+        self.breaks = breaks
+        self.amino_acid = amino_acid
+        self.record = record
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+    @property
+    def sequence(self):
+        return self.record.fasta_seq[self.start : self.end]
+
+    @property
+    def match_break(self):
+        return f"{self.format_breaks(self.amino_acid)}_{self.start}to{self.end}"
+
+    def format_breaks(self, amino_acid):
+        """Returns the residue counts around each break, e.g. Q4AQ3 for QQQQAQQQ."""
+        segments = []
+        previous = 0
+        for offset, break_id in self.breaks:
+            segments.append(f"{amino_acid}{offset - previous}{break_id}")
+            previous = offset + 1
+        segments.append(f"{amino_acid}{self.length - previous}")
+        return "".join(segments)
 
-    def __init__(self, input_dir, output_dir, input_basename, amino_acid, i):
-        log(f"Finding poly chains in {input_basename}.")
 
+class PolyOutput:
+    """Holds the output paths, files and report writers of one homorepeat residue.
+
+    With the sqlite report format both CSV reports are replaced by a single
+    SqliteReport in reports/, see poly_report.py.
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        input_basename,
+        amino_acid,
+        detector,
+        i,
+        suffix="",
+        compress=False,
+        report_format="csv",
+        residue_column=False,
+    ):
         self.amino_acid = amino_acid
-        self.fasta = Fasta()
-        self.protein_dir = os.path.join(args.output_directory, "translate_out")
-        self.output_dir = output_dir
-        self.protein_file_path = os.path.join(protein_dir, input_basename)
-        self.input_dir = input_dir
-        self.nucleotide_file_path = os.path.join(input_dir, input_basename)
+        self.detector = detector
+        self.report_format = report_format
+        # Reports of a single residue keep the columns they always had
+        self.residue_column = residue_column
         self.csv_writers = {}
-
-        ensure_directory_exists(os.path.join(output_dir, "reports_no_isoforms"))
-        self.report_file_path = os.path.join(
-            output_dir,
-            "reports_no_isoforms",
-            f"{os.path.splitext(input_basename)[0]}_{i}.csv",
-        )
+        self.report = None
+        input_name = os.path.splitext(strip_compression_suffix(input_basename))[0]
+        output_name = f"{input_name}_{i}{suffix}"
 
         ensure_directory_exists(os.path.join(output_dir, "reports"))
-        self.report_file_path_normal = os.path.join(
-            output_dir, "reports", f"{os.path.splitext(input_basename)[0]}_{i}.csv"
-        )
+        if report_format == "sqlite":
+            self.report_file_path = None
+            self.report_file_path_normal = os.path.join(
+                output_dir, "reports", f"{output_name}.sqlite"
+            )
+        else:
+            ensure_directory_exists(os.path.join(output_dir, "reports_no_isoforms"))
+            self.report_file_path = os.path.join(
+                output_dir, "reports_no_isoforms", f"{output_name}.csv"
+            )
+            self.report_file_path_normal = os.path.join(
+                output_dir, "reports", f"{output_name}.csv"
+            )
 
         ensure_directory_exists(os.path.join(output_dir, "matches_protein"))
-        self.output_file_path = os.path.join(
-            output_dir,
-            "matches_protein",
-            f"{os.path.splitext(input_basename)[0]}_{i}.fasta",
+        self.output_file_path = output_path(
+            os.path.join(output_dir, "matches_protein", f"{output_name}.fasta"),
+            compress,
         )
 
         ensure_directory_exists(os.path.join(output_dir, "matches_nucleotide"))
-        self.output_nucleotide_file_path = os.path.join(
-            output_dir,
-            "matches_nucleotide",
-            f"{os.path.splitext(input_basename)[0]}_{i}.fasta",
+        self.output_nucleotide_file_path = output_path(
+            os.path.join(output_dir, "matches_nucleotide", f"{output_name}.fasta"),
+            compress,
+        )
+
+    def create_csv_file(self, writer_name, report_file):
+        self.csv_writers[writer_name] = csv.writer(report_file)
+        self.csv_writers[writer_name].writerow(
+            [
+                "Fasta ID",
+                "Seq Name",
+                "Match Start",
+                "Full sequence",
+                "Length",
+                "Sequence",
+                "rootseq",
+                "nucseq",
+                "taxonomy",
+            ]
+            + (["Amino Acid"] if self.residue_column else [])
+        )
+
+    def open_files(self, stack):
+        """Opens every output file on the ExitStack and writes the CSV headers."""
+        self.output_file = stack.enter_context(open_output(self.output_file_path))
+        self.output_nucleotide_file = stack.enter_context(
+            open_output(self.output_nucleotide_file_path)
+        )
+        if self.report_format == "sqlite":
+            self.report = stack.enter_context(
+                SqliteReport(self.report_file_path_normal)
+            )
+            return
+        self.create_csv_file(
+            "isoform", stack.enter_context(open(self.report_file_path_normal, "w"))
+        )
+        self.create_csv_file(
+            "no_isoform",
+            stack.enter_context(open(self.report_file_path, "w", newline="")),
+        )
+
+    @staticmethod
+    def part_path(file_path, shard_index):
+        return f"{file_path}.part{shard_index}"
+
+    def output_paths(self):
+        """Returns every output file of the residue."""
+        return [
+            path
+            for path in (
+                self.report_file_path,
+                self.report_file_path_normal,
+                self.output_file_path,
+                self.output_nucleotide_file_path,
+            )
+            if path is not None
+        ]
+
+    def part_file_paths(self):
+        """Returns the outputs written while scanning, the ones a shard writes as part files.
+
+        A sqlite report is not included, its parts are merged by SqliteReport.merge.
+        """
+        paths = [self.output_file_path, self.output_nucleotide_file_path]
+        if self.report_format == "sqlite":
+            return paths
+        return [self.report_file_path_normal] + paths
+
+    def open_part_files(self, stack, shard_index):
+        """Opens the part files of one shard on the ExitStack, they are never compressed."""
+        self.output_file = stack.enter_context(
+            open(self.part_path(self.output_file_path, shard_index), "w")
+        )
+        self.output_nucleotide_file = stack.enter_context(
+            open(self.part_path(self.output_nucleotide_file_path, shard_index), "w")
+        )
+        if self.report_format == "sqlite":
+            self.report = stack.enter_context(
+                SqliteReport(self.part_path(self.report_file_path_normal, shard_index))
+            )
+            return
+        self.csv_writers["isoform"] = csv.writer(
+            stack.enter_context(
+                open(self.part_path(self.report_file_path_normal, shard_index), "w")
+            )
         )
 
+
+class Poly:
+    """Handles the matching of polys and sorting them into diferent outputs.
+
+    Every record is read once and scanned with the detector of each residue.
+    """
+
+    def __init__(
+        self,
+        input_dir,
+        output_dir,
+        input_basename,
+        detectors,
+        i,
+        single_pass=False,
+        compress_output=False,
+        report_format="csv",
+        translation_cache=None,
+        translation_cache_size=DEFAULT_MAX_SIZE,
+    ):
+        log(f"Finding poly chains in {input_basename}.")
+
+        self.single_pass = single_pass
+        self.report_format = report_format
+        self.translation_cache = translation_cache
+        self.translation_cache_size = translation_cache_size
+        self.fasta = Fasta()
+        self.protein_dir = os.path.join(output_dir, "translate_out")
+        self.output_dir = output_dir
+        self.protein_file_path = os.path.join(self.protein_dir, input_basename)
+        self.input_dir = input_dir
+        self.nucleotide_file_path = os.path.join(input_dir, input_basename)
+
+        # A single residue keeps the plain output names and report columns,
+        # several get a poly suffix each and an Amino Acid column
+        self.residue_column = len(detectors) > 1
+        self.outputs = [
+            PolyOutput(
+                output_dir,
+                input_basename,
+                amino_acid,
+                detector,
+                i,
+                f"_poly{amino_acid}" if self.residue_column else "",
+                compress_output,
+                report_format,
+                self.residue_column,
+            )
+            for amino_acid, detector in detectors.items()
+        ]
+
         self.taxonomy = re.search(r".*_([^_]+ae)_.*", input_basename).group(1)
 
-    def find_matches(self, pattern, header, sequence, nucsequence):
-        matches = pattern.finditer(sequence)
+    def input_paths(self):
+        """Returns the files the records are read from, the first one is the one sharded."""
+        if self.single_pass:
+            return [self.nucleotide_file_path]
+        return [self.protein_file_path, self.nucleotide_file_path]
+
+    def output_paths(self):
+        return [path for output in self.outputs for path in output.output_paths()]
+
+    def find_matches(self, spans, amino_acid, record):
         return [
-            Match(match, self.amino_acid, header, sequence, nucsequence)
-            for match in matches
+            Match(start, end, breaks, amino_acid, record) for start, end, breaks in spans
         ]
 
-    def create_csv_report(self, match, csv_writer):
-        """Writes the match information to a CSV file."""
-        row = [
-            f"{match.fasta_id.strip()} [{match.match_break}]",
-            match.name,
-            match.match_object.start() + 1,
+    def report_row(self, match):
+        """Returns the CSV report row of a match."""
+        record = match.record
+        match_break = match.match_break
+        return [
+            f"{record.fasta_id.strip()} [{match_break}]",
+            record.name,
+            match.start + 1,
             match.sequence,
             match.length,
-            match.match_break,
-            match.fasta_seq,
-            match.nucsequence,
+            match_break,
+            record.fasta_seq,
+            record.nucsequence,
             self.taxonomy,
-        ]
-        csv_writer.writerow(row)
+        ] + ([match.amino_acid] if self.residue_column else [])
+
+    def create_csv_report(self, match, csv_writer):
+        """Writes the match information to a CSV file."""
+        csv_writer.writerow(self.report_row(match))
 
     def append_to_output(self, output_file, matches, sequence):
         """Appends fasta match (header and poly info) information to the output file."""
         breaks = [x.match_break for x in matches]
         output_file.write(
-            f"{matches[0].fasta_id.strip()} [poly={'_'.join(breaks)}]\n{sequence}\n"
+            f"{matches[0].record.fasta_id.strip()} [poly={'_'.join(breaks)}]\n{sequence}\n"
         )
 
-    def post_match(self, matches, writer_name):
+    def post_match(self, output, matches, writer_name):
         for match in matches:
-            self.create_csv_report(match, self.csv_writers[writer_name])
+            self.create_csv_report(match, output.csv_writers[writer_name])
 
-    def process_lines(self):
-        """Processes lines in the data file, finds matches, and writes to report and output files."""
-        protein_generator = self.fasta.parse_generator(self.protein_file_path)
-        nucleotide_generator = self.fasta.parse_generator(self.nucleotide_file_path)
-        log(f"Nucleotide file path = {self.nucleotide_file_path}")
-        log(f"Protein file path: {self.protein_file_path}")
+    def report_isoform(self, output, offsets, matches):
+        """Writes the matches of a record to the isoform report."""
+        if output.report is None:
+            self.post_match(output, matches, "isoform")
+        else:
+            # The nucleotide offset is unique in the input, it keys the record across shards
+            output.report.add_sequence(
+                offsets[0], matches[0].record, matches, self.taxonomy
+            )
 
-        seen_gene_ids = {}  # Dictionary to track the largest protein for each Gene ID
+    def report_largest_isoforms(self, output, readers, isoforms):
+        """Writes the isoforms kept by track_largest_isoform to the report without isoforms.
 
-        for (prot_id, prot_sequence), (nuc_id, nuc_sequence) in zip(
-            protein_generator, nucleotide_generator
-        ):
-            # Find matches for the current protein sequence
-            matches = self.find_matches(PATTERN, prot_id, prot_sequence, nuc_sequence)
+        A sqlite report already holds their records, they are only flagged.
+        """
+        if output.report is not None:
+            output.report.mark_largest_isoforms(
+                [nuc_offset for _, (nuc_offset, _), _ in isoforms]
+            )
+            return
+        for isoform in isoforms:
+            matches = self.read_isoform(readers, output.amino_acid, isoform)
+            self.post_match(output, matches, "no_isoform")
+
+    @contextlib.contextmanager
+    def open_translator(self):
+        """Yields a function translating a list of CDS, through the translation cache when one is set."""
+        if self.translation_cache is None:
+            yield lambda sequences: [
+                translate_sequence(sequence) for sequence in sequences
+            ]
+            return
+
+        with TranslationCache(
+            self.translation_cache,
+            CACHE_MODE,
+            translate_sequence,
+            self.translation_cache_size,
+        ) as cache:
+            yield cache.translate_batch
+            log(f"Translation cache: {cache.hits} hits, {cache.misses} misses")
+
+    def record_generator(self, shard=None):
+        """Yields (offsets, header, protein, nucleotide) for every record of the input.
+
+        In single pass mode each CDS is read once and translated in memory,
+        otherwise the translate_out protein file is read alongside the nucleotide file.
+        offsets are the (nucleotide, protein) byte offsets of the record, see read_isoform.
+        A shard, as returned by plan_shards, limits the records to its byte ranges.
+        """
+        nucleotide_range, protein_range = shard or ((0, None), (0, None))
+        nucleotide_generator = self.fasta.parse_offset_generator(
+            self.nucleotide_file_path, *nucleotide_range
+        )
+        log(f"Nucleotide file path = {self.nucleotide_file_path}")
 
-            if matches:  # Proceed only if matches are found
-                self.append_to_output(self.output_file, matches, prot_sequence)
-                self.append_to_output(
-                    self.output_nucleotide_file, matches, nuc_sequence
-                )
-                self.post_match(matches, "isoform")
-                gene_id = matches[0].geneid  # Use the first match to get the Gene ID
-
-                # Check if the Gene ID is already seen or if the current protein is larger
-                if gene_id not in seen_gene_ids:
-                    # If it's a new Gene ID, store the current protein and its details
-                    seen_gene_ids[gene_id] = {
-                        "protein_id": prot_id,
-                        "nucleotide_sequence": nuc_sequence,
-                        "matches": matches,
-                    }
-                else:
-                    # If we've seen this Gene ID, compare lengths
-                    current_largest = seen_gene_ids[gene_id]
-                    if len(nuc_sequence) > len(current_largest["nucleotide_sequence"]):
-                        # Update to the larger protein sequence
-                        seen_gene_ids[gene_id] = {
-                            "protein_id": prot_id,
-                            "nucleotide_sequence": nuc_sequence,
-                            "matches": matches,
-                        }
+        if self.single_pass:
+            with self.open_translator() as translate_batch:
+                for batch in batched(nucleotide_generator):
+                    proteins = translate_batch(
+                        [nuc_sequence for _, _, nuc_sequence in batch]
+                    )
+                    for (nuc_offset, nuc_id, nuc_sequence), prot_sequence in zip(
+                        batch, proteins
+                    ):
+                        yield (nuc_offset, None), nuc_id, prot_sequence, nuc_sequence
+            return
+
+        protein_generator = self.fasta.parse_offset_generator(
+            self.protein_file_path, *protein_range
+        )
+        log(f"Protein file path: {self.protein_file_path}")
+        for (prot_offset, prot_id, prot_sequence), (
+            nuc_offset,
+            nuc_id,
+            nuc_sequence,
+        ) in zip(protein_generator, nucleotide_generator):
+            yield (nuc_offset, prot_offset), prot_id, prot_sequence, nuc_sequence
 
-        # Write only the largest proteins to output files
-        log(
-            f"{len(seen_gene_ids)} gene matches in {os.path.basename(self.nucleotide_file_path)}"
+    @staticmethod
+    def track_largest_isoform(seen_gene_ids, gene_id, nuc_length, offsets, spans):
+        """Keeps the largest protein of gene_id in seen_gene_ids.
+
+        Only (nucleotide length, record offsets, match spans) is kept per Gene ID,
+        the sequences are read again by offset when the report is written.
+        """
+        # Check if the Gene ID is already seen or if the current protein is larger
+        if gene_id not in seen_gene_ids or nuc_length > seen_gene_ids[gene_id][0]:
+            seen_gene_ids[gene_id] = (nuc_length, offsets, spans)
+
+    def open_readers(self, stack, isoforms):
+        """Opens the input files the isoforms are read back from."""
+        nucleotide_reader = stack.enter_context(
+            Fasta.open_reader(
+                self.nucleotide_file_path,
+                [nuc_offset for _, (nuc_offset, _), _ in isoforms],
+            )
+        )
+        if self.single_pass:
+            return nucleotide_reader, None
+        return nucleotide_reader, stack.enter_context(
+            Fasta.open_reader(
+                self.protein_file_path,
+                [prot_offset for _, (_, prot_offset), _ in isoforms],
+            )
         )
-        for gene_id, data in seen_gene_ids.items():
-            self.post_match(data["matches"], "no_isoform")
 
-    def create_csv_file(self, writer_name, report_file):
-        self.csv_writers[writer_name] = csv.writer(report_file)
-        self.csv_writers[writer_name].writerow(
-            [
-                "Fasta ID",
-                "Seq Name",
-                "Match Start",
-                "Full sequence",
-                "Length",
-                "Sequence",
-                "rootseq",
-                "nucseq",
-                "taxonomy",
-            ]
+    def read_isoform(self, readers, amino_acid, isoform):
+        """Rebuilds the matches of an isoform kept by track_largest_isoform."""
+        nucleotide_reader, protein_reader = readers
+        _, (nuc_offset, prot_offset), spans = isoform
+        header, nuc_sequence = nucleotide_reader.read(nuc_offset)
+        if protein_reader is None:
+            prot_sequence = translate_sequence(nuc_sequence)
+        else:
+            header, prot_sequence = protein_reader.read(prot_offset)
+        return self.find_matches(
+            spans, amino_acid, Record(header, prot_sequence, nuc_sequence)
         )
 
+    def scan_records(self, records):
+        """Finds matches in the records, writes them to the output files and the isoform reports.
+
+        Returns a dictionary per residue with the largest protein of each Gene ID.
+        """
+        seen_gene_ids = {output.amino_acid: {} for output in self.outputs}
+
+        for batch in batched(records):
+            # Detectors scan the proteins of a whole batch at once
+            proteins = [prot_sequence for _, _, prot_sequence, _ in batch]
+            batch_spans = {
+                output.amino_acid: output.detector.find_batch(proteins)
+                for output in self.outputs
+            }
+
+            for index, (offsets, prot_id, prot_sequence, nuc_sequence) in enumerate(
+                batch
+            ):
+                record = None
+                for output in self.outputs:
+                    spans = batch_spans[output.amino_acid][index]
+                    if not spans:  # Proceed only if matches are found
+                        continue
+
+                    # The header is parsed once per record, for its first residue with matches
+                    if record is None:
+                        record = Record(prot_id, prot_sequence, nuc_sequence)
+                    matches = self.find_matches(spans, output.amino_acid, record)
+
+                    self.append_to_output(output.output_file, matches, prot_sequence)
+                    self.append_to_output(
+                        output.output_nucleotide_file, matches, nuc_sequence
+                    )
+                    self.report_isoform(output, offsets, matches)
+                    self.track_largest_isoform(
+                        seen_gene_ids[output.amino_acid],
+                        record.geneid,
+                        len(nuc_sequence),
+                        offsets,
+                        spans,
+                    )
+
+        return seen_gene_ids
+
+    def process_lines(self):
+        """Processes lines in the data file, finds matches, and writes to report and output files."""
+        seen_gene_ids = self.scan_records(self.record_generator())
+
+        # Write only the largest proteins to output files
+        with contextlib.ExitStack() as stack:
+            readers = None
+            if self.report_format == "csv":
+                readers = self.open_readers(
+                    stack,
+                    [
+                        isoform
+                        for residue_gene_ids in seen_gene_ids.values()
+                        for isoform in residue_gene_ids.values()
+                    ],
+                )
+            for output in self.outputs:
+                residue_gene_ids = seen_gene_ids[output.amino_acid]
+                log(
+                    f"{len(residue_gene_ids)} poly{output.amino_acid} gene matches in {os.path.basename(self.nucleotide_file_path)}"
+                )
+                self.report_largest_isoforms(
+                    output, readers, list(residue_gene_ids.values())
+                )
+
     def process_file(self):
-        with open(self.protein_file_path, "r") as data_file, open(
-            self.report_file_path, "w", newline=""
-        ) as report_file, open(self.output_file_path, "w") as self.output_file, open(
-            self.output_nucleotide_file_path, "w"
-        ) as self.output_nucleotide_file, open(
-            self.report_file_path_normal, "w"
-        ) as isoform_report_file:
-
-            self.create_csv_file("isoform", isoform_report_file)
-            self.create_csv_file("no_isoform", report_file)
+        with contextlib.ExitStack() as stack:
+            for output in self.outputs:
+                output.open_files(stack)
             self.process_lines()
 
+    def plan_shards(self, shard_size):
+        """Splits the input in shards of roughly shard_size bytes aligned on fasta records.
+
+        Each shard is a (nucleotide_range, protein_range) tuple, None is returned
+        when the input is small enough to be processed whole or is compressed.
+        """
+        input_paths = self.input_paths()
+        if any(is_compressed(path) for path in input_paths):
+            return None  # gzip streams can not be split by byte range
+
+        sharded_path = input_paths[0]
+        shards = -(-os.path.getsize(sharded_path) // shard_size)
+        if shards < 2:
+            return None
+
+        if self.single_pass:
+            return [
+                (nucleotide_range, (0, None))
+                for nucleotide_range in self.fasta.shard_ranges(sharded_path, shards)
+            ]
+        return [
+            (nucleotide_range, protein_range)
+            for protein_range, nucleotide_range in self.fasta.paired_shard_ranges(
+                self.protein_file_path, self.nucleotide_file_path, shards
+            )
+        ]
+
+    def process_shard(self, shard_index, shard):
+        """Scans one shard of the input into part files.
 
-if __name__ == "__main__":
+        Returns, per residue, the largest isoform of each Gene ID in the shard
+        as kept by track_largest_isoform, the offsets are absolute in the input files.
+        """
+        with contextlib.ExitStack() as stack:
+            for output in self.outputs:
+                output.open_part_files(stack, shard_index)
+            return self.scan_records(self.record_generator(shard))
+
+    @staticmethod
+    def append_parts(file_path, part_paths):
+        """Appends the part files to file_path in order and removes them."""
+        with open_output(file_path, "ab") as output_file:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, output_file, 1 << 20)
+                os.remove(part_path)
+
+    def merge_shards(self, shard_results):
+        """Joins the part files of every shard and writes the reports without isoforms.
+
+        Gene IDs keep the order of their first appearance and, like in process_lines,
+        the first of the largest isoforms is kept.
+        """
+        for output in self.outputs:
+            merged_gene_ids = {}
+            for shard_result in shard_results:
+                for gene_id, isoform in shard_result[output.amino_acid].items():
+                    self.track_largest_isoform(merged_gene_ids, gene_id, *isoform)
+
+            # The isoform report gets its header here, the fasta outputs start empty
+            with contextlib.ExitStack() as stack:
+                output.open_files(stack)
+                readers = None
+                if output.report is None:
+                    readers = self.open_readers(stack, merged_gene_ids.values())
+                else:
+                    output.report.merge(
+                        [
+                            output.part_path(output.report_file_path_normal, shard_index)
+                            for shard_index in range(len(shard_results))
+                        ]
+                    )
+                self.report_largest_isoforms(
+                    output, readers, list(merged_gene_ids.values())
+                )
+
+            for file_path in output.part_file_paths():
+                self.append_parts(
+                    file_path,
+                    [
+                        output.part_path(file_path, shard_index)
+                        for shard_index in range(len(shard_results))
+                    ],
+                )
+
+            log(
+                f"{len(merged_gene_ids)} poly{output.amino_acid} gene matches in {os.path.basename(self.nucleotide_file_path)}"
+            )
+
+
+def process_input_file(
+    input_dir,
+    output_dir,
+    input_basename,
+    detectors,
+    i,
+    single_pass,
+    compress_output,
+    report_format,
+    translation_cache,
+    translation_cache_size,
+):
+    """Runs a Poly over one input file, used as the unit of work of the process pool."""
+    poly = Poly(
+        input_dir,
+        output_dir,
+        input_basename,
+        detectors,
+        i,
+        single_pass,
+        compress_output,
+        report_format,
+        translation_cache,
+        translation_cache_size,
+    )
+    poly.process_file()
+    return input_basename
+
+
+def process_input_shard(poly_args, shard_index, shard):
+    """Runs a Poly over one shard of an input file, used as a unit of work of the process pool."""
+    return Poly(*poly_args).process_shard(shard_index, shard)
+
+
+def run_pool(executor, tasks, on_finished=None):
+    """Submits whole files and shards to the pool, sharded files are merged once all their shards finish.
+
+    on_finished is called with the basename of every file once its outputs are complete.
+    """
+    futures = {}
+    shard_results = {}
+    for poly_args, shards in tasks:
+        if shards is None:
+            futures[executor.submit(process_input_file, *poly_args)] = (poly_args, None)
+            continue
+        shard_results[poly_args[2]] = [None] * len(shards)
+        for shard_index, shard in enumerate(shards):
+            future = executor.submit(process_input_shard, poly_args, shard_index, shard)
+            futures[future] = (poly_args, shard_index)
+
+    for future in as_completed(futures):
+        poly_args, shard_index = futures[future]
+        if shard_index is None:
+            print(f"Finished: {future.result()}")
+        else:
+            results = shard_results[poly_args[2]]
+            results[shard_index] = future.result()
+            if any(result is None for result in results):
+                continue
+            Poly(*poly_args).merge_shards(results)
+            print(f"Finished: {poly_args[2]}")
+
+        if on_finished is not None:
+            on_finished(poly_args[2])
 
-    def ensure_directory_exists(path):
-        """Checks if directory exists, if not, creates it."""
-        if not os.path.exists(path):
-            os.makedirs(path)
 
+if __name__ == "__main__":
     # Makes code usable by CLI
     parser = argparse.ArgumentParser(description="Protein poly identifier.")
     parser.add_argument(
@@ -270,7 +715,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-aa",
         "--poly_amino_acid",
-        help="The aminoacid of chosen poly chain",
+        help="The aminoacid of chosen poly chain, several residues (e.g. QAE) or ALL scan every one in a single pass",
         required=True,
     )
     parser.add_argument(
@@ -287,32 +732,191 @@ if __name__ == "__main__":
         default=True,
         choices=["True", "true", "False", "false"],
     )
+    parser.add_argument(
+        "-mb",
+        "--max_breaks",
+        help="Number of single aminoacid breaks allowed in a homorepeat, overrides --break_poly",
+        required=False,
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "-dt",
+        "--detector",
+        help="Homorepeat detector, a regular expression or a NumPy run-length scan",
+        required=False,
+        default="regex",
+        choices=["regex", "rle"],
+    )
+    parser.add_argument(
+        "-sp",
+        "--single_pass",
+        help="Translate the input CDS in memory instead of reading translate_out",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of input files processed in parallel",
+        required=False,
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "-ss",
+        "--shard_size",
+        help="Split input files bigger than this size in MB into shards scanned in parallel",
+        required=False,
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "-co",
+        "--compress_output",
+        help="Write the fasta outputs compressed with bgzip (.gz)",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-rf",
+        "--report_format",
+        help="Format of the reports, CSV files or a normalized SQLite database per input file",
+        required=False,
+        default="csv",
+        choices=["csv", "sqlite"],
+    )
+    parser.add_argument(
+        "-inc",
+        "--incremental",
+        help="Skip input files whose outputs are up to date with the manifest of an earlier run",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-tc",
+        "--translation_cache",
+        help="SQLite file caching the proteins of translated CDS across runs, used in single pass mode",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "-tcs",
+        "--translation_cache_size",
+        help="Size in MB above which the least recently used proteins are evicted from the translation cache",
+        required=False,
+        default=DEFAULT_MAX_SIZE,
+        type=int,
+    )
     args = parser.parse_args()
+    single_pass = args.single_pass.capitalize() == "True"
+    compress_output = args.compress_output.capitalize() == "True"
+    incremental = args.incremental.capitalize() == "True"
 
     setup_logging(log_file=os.path.join(args.output_directory, "logfile.log"))
 
-    if args.break_poly.capitalize() == "True":
-        PATTERN = re.compile(
-            r"{0}{{{1},}}([^{0}]{0}+)?".format(args.poly_amino_acid, args.size)
-        )
-    else:
-        PATTERN = re.compile(r"{0}{{{1},}}".format(args.poly_amino_acid, args.size))
+    max_breaks = args.max_breaks
+    if max_breaks is None:
+        max_breaks = 1 if args.break_poly.capitalize() == "True" else 0
+    DETECTORS = create_detectors(
+        parse_amino_acids(args.poly_amino_acid), args.size, max_breaks, args.detector
+    )
 
-    protein_dir = os.path.join(args.output_directory, "translate_out")
+    if single_pass:
+        listing_dir = args.input_directory
+    else:
+        listing_dir = os.path.join(args.output_directory, "translate_out")
 
     try:
-        input_filenames = os.listdir(protein_dir)
+        input_filenames = Fasta.list_files(listing_dir)
 
     except FileNotFoundError:
-        raise FileNotFoundError(f"Invalid input directory: {protein_dir}")
+        raise FileNotFoundError(f"Invalid input directory: {listing_dir}")
+
+    # The detector is left out, every detector finds the same matches
+    manifest = Manifest(
+        args.output_directory,
+        "find_poly",
+        {
+            "amino_acids": list(DETECTORS),
+            "size": int(args.size),
+            "max_breaks": max_breaks,
+            "single_pass": single_pass,
+            "compress_output": compress_output,
+            "report_format": args.report_format,
+        },
+        incremental,
+    )
 
-    for i, input_basename in enumerate(input_filenames):
-        print(f"File: {input_basename}")
-        poly = Poly(
+    # The output index is fixed here, output names match a serial run. The manifest
+    # keeps the index of every file, so new files do not rename earlier outputs
+    tasks = []
+    file_paths = {}
+    for i, input_basename in zip(
+        manifest.assign_indices(input_filenames), input_filenames
+    ):
+        poly_args = (
             args.input_directory,
             args.output_directory,
             input_basename,
-            args.poly_amino_acid,
+            DETECTORS,
             i,
+            single_pass,
+            compress_output,
+            args.report_format,
+            args.translation_cache,
+            args.translation_cache_size,
         )
-        poly.process_file()
+        if not incremental and args.shard_size <= 0:
+            tasks.append((poly_args, None))
+            continue
+
+        poly = Poly(*poly_args)
+        file_paths[input_basename] = (poly.input_paths(), poly.output_paths())
+        if manifest.is_up_to_date(input_basename, *file_paths[input_basename]):
+            print(f"Up to date: {input_basename}")
+            log(f"Skipping {input_basename}, its outputs are up to date.")
+            continue
+
+        shards = None
+        if args.shard_size > 0:
+            shards = poly.plan_shards(args.shard_size * 1024 * 1024)
+        tasks.append((poly_args, shards))
+
+    def record_finished(input_basename):
+        if incremental:
+            manifest.record(input_basename, *file_paths[input_basename])
+
+    if args.workers > 1:
+        # Workers send their log records through a queue so only the parent writes the logfile
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            listener = logging.handlers.QueueListener(
+                log_queue, *logging.getLogger().handlers
+            )
+            listener.start()
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=args.workers,
+                    initializer=setup_worker_logging,
+                    initargs=(log_queue,),
+                ) as executor:
+                    run_pool(executor, tasks, record_finished)
+            finally:
+                listener.stop()
+    else:
+        for poly_args, shards in tasks:
+            print(f"File: {poly_args[2]}")
+            if shards is None:
+                process_input_file(*poly_args)
+            else:
+                Poly(*poly_args).merge_shards(
+                    [
+                        process_input_shard(poly_args, shard_index, shard)
+                        for shard_index, shard in enumerate(shards)
+                    ]
+                )
+            record_finished(poly_args[2])
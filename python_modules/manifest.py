@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """Records the inputs, parameters and outputs of each file a stage processed.
+
+    The manifest is kept in the output directory as .manifest_<stage>.json. An entry
+    is up to date when the run has the same parameters, its inputs have the same
+    content and every output still exists, so a rerun only processes new or changed
+    files. Input hashes are only computed again when the size or modification time
+    of a file changes. The manifest is saved after every entry, an interrupted run
+    resumes from the first file that was not finished.
+    A disabled manifest never skips nor records anything.
+    """
+
+    def __init__(self, directory, stage, params, enabled=True):
+        self.directory = directory
+        self.path = os.path.join(directory, f".manifest_{stage}.json")
+        self.enabled = enabled
+        # Round trip so tuples compare equal to the lists read back from the file
+        self.params = json.loads(json.dumps(params))
+        self.data = {
+            "version": MANIFEST_VERSION,
+            "files": {},
+            "entries": {},
+            "indices": {},
+        }
+        if enabled:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError):
+            return  # first run or an unreadable manifest, everything is processed
+        if data.get("version") == MANIFEST_VERSION:
+            self.data = data
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.data, manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def file_hash(self, path):
+        """Returns the sha256 of a file, cached by its size and modification time."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self.data["files"].get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        self.data["files"][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def input_hashes(self, input_paths):
+        return {
+            os.path.abspath(path): self.file_hash(path) for path in input_paths
+        }
+
+    def entry(self, key):
+        return self.data["entries"].get(key)
+
+    def is_up_to_date(self, key, input_paths, output_paths=None):
+        """Checks an entry, output_paths can be left out when they are only known after processing."""
+        if not self.enabled:
+            return False
+        entry = self.entry(key)
+        if entry is None or entry["params"] != self.params:
+            return False
+        if output_paths is not None and sorted(entry["outputs"]) != sorted(
+            map(os.path.abspath, output_paths)
+        ):
+            return False
+        if not all(os.path.exists(path) for path in entry["outputs"]):
+            return False
+        try:
+            return entry["inputs"] == self.input_hashes(input_paths)
+        except OSError:
+            return False
+
+    def record(self, key, input_paths, output_paths):
+        """Saves the entry of a processed file."""
+        if not self.enabled:
+            return
+        self.data["entries"][key] = {
+            "params": self.params,
+            "inputs": self.input_hashes(input_paths),
+            "outputs": [os.path.abspath(path) for path in output_paths],
+        }
+        self.save()
+
+    def assign_indices(self, keys):
+        """Returns a stable index for each key, keys new to the manifest get the next free ones.
+
+        On a first run the indices are the positions of the keys, like enumerate.
+        """
+        indices = self.data["indices"]
+        next_index = max(indices.values(), default=-1) + 1
+        for key in keys:
+            if key not in indices:
+                indices[key] = next_index
+                next_index += 1
+        if self.enabled:
+            self.save()
+        return [indices[key] for key in keys]
@@ -0,0 +1,104 @@
+import argparse
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no ioctl outside of unix, reflinks fall back to copies
+
+PLACEMENT_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+# ioctl cloning a whole file on filesystems with reflinks (btrfs, XFS, bcachefs...)
+FICLONE = 0x40049409
+
+# Errors of a link or clone the filesystem can not make, the file is copied instead:
+# across devices, unsupported by the filesystem, or too many links to the file
+FALLBACK_ERRORS = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EPERM,
+    errno.EMLINK,
+}
+
+
+def reflink(source, destination):
+    """Clones source to destination sharing its blocks, returns False when the filesystem can not."""
+    if fcntl is None:
+        return False
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            cloned = True
+        except OSError as error:
+            if error.errno not in FALLBACK_ERRORS:
+                raise
+            cloned = False
+    if not cloned:
+        os.remove(destination)
+        return False
+    shutil.copymode(source, destination)
+    return True
+
+
+def place_file(source, destination, mode="copy"):
+    """Places source at destination, returns how it was placed: copy, hardlink, reflink or symlink.
+
+    A hardlink across devices or a reflink the filesystem does not support is made
+    a copy. Symlinks point to the absolute path of the original file, placing a
+    symlink again does not chain links. Whatever is at destination is replaced.
+    """
+    source = os.path.realpath(source)
+    if os.path.abspath(destination) == source:
+        raise shutil.SameFileError(f"{source} would be placed onto itself")
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if mode == "symlink":
+        os.symlink(source, destination)
+        return "symlink"
+    if mode == "hardlink":
+        try:
+            os.link(source, destination)
+            return "hardlink"
+        except OSError as error:
+            if error.errno not in FALLBACK_ERRORS:
+                raise
+    elif mode == "reflink" and reflink(source, destination):
+        return "reflink"
+    shutil.copy(source, destination)
+    return "copy"
+
+
+def place_directory(input_dir, output_dir, mode="copy"):
+    """Places every file of input_dir in output_dir, hidden files such as manifests are left out."""
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name in sorted(os.listdir(input_dir)):
+        source = os.path.join(input_dir, file_name)
+        if file_name.startswith(".") or not os.path.isfile(source):
+            continue
+        destination = os.path.join(output_dir, file_name)
+        placed = place_file(source, destination, mode)
+        print(f"'{source}' -> '{destination}' ({placed})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Places the files of a directory in another one by copy, hardlink, reflink or symlink."
+    )
+    parser.add_argument("-id", "--input_directory", help="Directory containing input files", required=True)
+    parser.add_argument("-od", "--output_directory", help="Directory the files are placed in", required=True)
+    parser.add_argument(
+        "-pm",
+        "--placement",
+        help="Copy the files, or hardlink, reflink or symlink them to the input files (hardlinks and reflinks are copied when not possible)",
+        required=False,
+        default="copy",
+        choices=PLACEMENT_MODES,
+    )
+    args = parser.parse_args()
+
+    place_directory(args.input_directory, args.output_directory, args.placement)
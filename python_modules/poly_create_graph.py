@@ -1,11 +1,14 @@
 import argparse
+import contextlib
 import os
 import re
 import shutil
+import sqlite3
 import pandas as pd
 import re
 import math
 from boxplot_generation import Boxplot
+from poly_report import LARGEST_ISOFORMS_QUERY
 
 
 class csvFixer:
@@ -38,9 +41,18 @@ class csvFixer:
 
 
 class DataRetrieve:
+    """Loads a report without isoforms, a CSV file or a sqlite report of find_poly.
+
+    Sqlite reports only load the lengths of the proteins and the codons of the
+    matches, instead of the whole rootseq and nucseq columns.
+    """
 
     def __init__(self, file_path):
-        self.data = pd.read_csv(file_path)
+        if file_path.endswith(".sqlite"):
+            with contextlib.closing(sqlite3.connect(file_path)) as connection:
+                self.data = pd.read_sql_query(LARGEST_ISOFORMS_QUERY, connection)
+        else:
+            self.data = pd.read_csv(file_path)
 
     def get_column_list(self, column_name):
         res = [i for i in self.data[column_name]]
@@ -51,10 +63,7 @@ class DataRetrieve:
     ):
         match_start = self.get_column_list("Match Start")
         match_start = [(x) * 3 for x in match_start]
-        total_length = []
-
-        for index, row in self.data.iterrows():
-            total_length.append(len(row["rootseq"]) * 3)
+        total_length = [x * 3 for x in self.rootseq_lengths()]
 
         start_point = [
             round((x / y) * 100, 2) for x, y in zip(match_start, total_length)
@@ -116,18 +125,29 @@ class DataRetrieve:
         res = [i for i in self.data[column_name]]
         return res
 
-    def caacag_relations(self):
-        nucleotide_data = self.get_column_list("nucseq")
-        polyQ_nucleotide = []  # Initialize an empty list
+    def rootseq_lengths(self):
+        if "rootseq_length" in self.data:
+            return self.get_column_list("rootseq_length")
+        return [len(x) for x in self.get_column_list("rootseq")]
 
+    def polyq_nucleotides(self):
+        """Returns the codons of each match, starting at the nucleotide of Match Start * 3."""
+        if "poly_nucseq" in self.data:
+            return self.get_column_list("poly_nucseq")
+
+        polyQ_nucleotide = []  # Initialize an empty list
         for nucleotide, match_index, length_value in zip(
-            nucleotide_data,
+            self.get_column_list("nucseq"),
             [x * 3 for x in self.get_column_list("Match Start")],
             self.get_column_list("Length"),
         ):
             polyQ_nucleotide.append(
                 nucleotide[match_index : match_index + length_value * 3]
             )
+        return polyQ_nucleotide
+
+    def caacag_relations(self):
+        polyQ_nucleotide = self.polyq_nucleotides()
 
         codons_count = []  # Initialize an empty list
         for sequence in polyQ_nucleotide:
@@ -0,0 +1,142 @@
+import itertools
+import re
+
+import numpy as np
+
+# The 20 standard amino acids, selected with -aa ALL
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# Number of sequences handed to a detector at once
+BATCH_SIZE = 1024
+
+
+def parse_amino_acids(amino_acid_arg):
+    """Returns the residues of an -aa argument in order, e.g. "Q", "QAEPS" or "ALL"."""
+    if amino_acid_arg.upper() == "ALL":
+        return list(AMINO_ACIDS)
+
+    amino_acids = []
+    for amino_acid in amino_acid_arg.replace(",", ""):
+        if amino_acid not in amino_acids:
+            amino_acids.append(amino_acid)
+    return amino_acids
+
+
+def batched(iterable, size=BATCH_SIZE):
+    """Yields lists of up to size consecutive items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class RegexDetector:
+    """Finds homorepeats with a regular expression, one sequence at a time.
+
+    A repeat is a run of at least size residues followed by up to max_breaks
+    single aminoacid breaks, each one followed by more of the residue.
+    """
+
+    def __init__(self, amino_acid, size, max_breaks):
+        self.amino_acid = amino_acid
+        if max_breaks:
+            self.pattern = re.compile(
+                r"{0}{{{1},}}(?:[^{0}]{0}+){{0,{2}}}".format(
+                    amino_acid, size, max_breaks
+                )
+            )
+        else:
+            self.pattern = re.compile(r"{0}{{{1},}}".format(amino_acid, size))
+        self.break_pattern = re.compile(f"[^{amino_acid}]")
+
+    def find(self, sequence):
+        """Returns the (start, end, breaks) of every repeat, breaks being (offset in repeat, aminoacid) tuples."""
+        matches = []
+        for match in self.pattern.finditer(sequence):
+            breaks = tuple(
+                (non_residue.start(), non_residue.group())
+                for non_residue in self.break_pattern.finditer(match.group())
+            )
+            matches.append((match.start(), match.end(), breaks))
+        return matches
+
+    def find_batch(self, sequences):
+        return [self.find(sequence) for sequence in sequences]
+
+
+class RunLengthDetector:
+    """Finds homorepeats from the run-length encoding of a batch of sequences.
+
+    The sequences are joined in one byte array and every run of the residue is
+    found at once with NumPy, runs separated by a single other aminoacid are
+    then joined up to max_breaks times. Results are the same as RegexDetector.
+    """
+
+    # Two characters keep the runs of neighbouring sequences from being joined
+    SEPARATOR = "\n\n"
+
+    def __init__(self, amino_acid, size, max_breaks):
+        self.amino_acid = amino_acid
+        self.residue = ord(amino_acid)
+        self.size = size
+        self.max_breaks = max_breaks
+
+    def find(self, sequence):
+        return self.find_batch([sequence])[0]
+
+    def find_batch(self, sequences):
+        """Returns the (start, end, breaks) of every repeat of each sequence, see RegexDetector.find."""
+        matches = [[] for _ in sequences]
+        data = np.frombuffer(
+            self.SEPARATOR.join(sequences).encode("ascii"), dtype=np.uint8
+        )
+        is_residue = np.zeros(len(data) + 2, dtype=np.int8)
+        is_residue[1:-1] = data == self.residue
+        edges = np.diff(is_residue)
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+
+        long_runs = np.flatnonzero(run_ends - run_starts >= self.size)
+        if not len(long_runs):
+            return matches
+
+        joinable = (run_starts[1:] - run_ends[:-1]) == 1
+        sequence_starts = np.zeros(len(sequences), dtype=np.int64)
+        sequence_starts[1:] = np.cumsum(
+            [len(sequence) + len(self.SEPARATOR) for sequence in sequences[:-1]]
+        )
+        owners = np.searchsorted(sequence_starts, run_starts[long_runs], side="right") - 1
+
+        next_run = 0
+        for first, owner in zip(long_runs.tolist(), owners.tolist()):
+            if first < next_run:
+                continue  # already part of the previous repeat
+            last = first
+            while (
+                last - first < self.max_breaks
+                and last < len(joinable)
+                and joinable[last]
+            ):
+                last += 1
+            start = int(run_starts[first])
+            offset = int(sequence_starts[owner])
+            breaks = tuple(
+                (int(run_ends[run]) - start, chr(data[run_ends[run]]))
+                for run in range(first, last)
+            )
+            matches[owner].append((start - offset, int(run_ends[last]) - offset, breaks))
+            next_run = last + 1
+        return matches
+
+
+DETECTORS = {"regex": RegexDetector, "rle": RunLengthDetector}
+
+
+def create_detectors(amino_acids, size, max_breaks, detector="regex"):
+    """Returns a dictionary with the homorepeat detector of each residue."""
+    return {
+        amino_acid: DETECTORS[detector](amino_acid, int(size), max_breaks)
+        for amino_acid in amino_acids
+    }
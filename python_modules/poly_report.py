@@ -0,0 +1,131 @@
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE sequences (
+    sequence_id INTEGER PRIMARY KEY,
+    fasta_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    gene_id TEXT NOT NULL,
+    taxonomy TEXT NOT NULL,
+    protein TEXT NOT NULL,
+    nucleotide TEXT NOT NULL,
+    largest_isoform INTEGER NOT NULL DEFAULT 0,
+    gene_order INTEGER
+);
+CREATE TABLE matches (
+    sequence_id INTEGER NOT NULL REFERENCES sequences (sequence_id),
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    match_break TEXT NOT NULL,
+    amino_acid TEXT NOT NULL
+);
+CREATE VIEW report AS
+SELECT
+    s.fasta_id || ' [' || m.match_break || ']' AS "Fasta ID",
+    s.name AS "Seq Name",
+    m.start + 1 AS "Match Start",
+    substr(s.protein, m.start + 1, m.length) AS "Full sequence",
+    m.length AS "Length",
+    m.match_break AS "Sequence",
+    s.protein AS rootseq,
+    s.nucleotide AS nucseq,
+    s.taxonomy AS taxonomy,
+    m.amino_acid AS "Amino Acid",
+    s.largest_isoform AS largest_isoform
+FROM matches AS m JOIN sequences AS s USING (sequence_id)
+ORDER BY m.sequence_id, m.start;
+"""
+
+# The columns poly_create_graph needs from the reports without isoforms, the
+# sequences are measured and sliced by SQLite instead of being loaded whole
+LARGEST_ISOFORMS_QUERY = """
+SELECT
+    s.name AS "Seq Name",
+    m.start + 1 AS "Match Start",
+    m.length AS "Length",
+    length(s.protein) AS rootseq_length,
+    substr(s.nucleotide, (m.start + 1) * 3 + 1, m.length * 3) AS poly_nucseq
+FROM matches AS m JOIN sequences AS s USING (sequence_id)
+WHERE s.largest_isoform = 1
+ORDER BY s.gene_order, m.start
+"""
+
+
+class SqliteReport:
+    """Normalized report of one input file, the alternative to the CSV reports.
+
+    Every protein with matches is stored once in sequences, keyed by its byte
+    offset in the input, and each homorepeat is a row of typed columns in matches.
+    The largest isoforms, the rows of reports_no_isoforms, are flagged with
+    largest_isoform and ordered by gene_order. The report view has the CSV columns.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.connection = sqlite3.connect(path)
+        # A report is rebuilt from scratch on failure, so no rollback journal is kept
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def add_sequence(self, sequence_id, record, matches, taxonomy):
+        """Stores a protein and its matches, record is the find_poly Record shared by the matches."""
+        self.connection.execute(
+            "INSERT INTO sequences (sequence_id, fasta_id, name, gene_id, taxonomy, protein, nucleotide)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                sequence_id,
+                record.fasta_id.strip(),
+                record.name,
+                record.geneid,
+                taxonomy,
+                record.fasta_seq,
+                record.nucsequence,
+            ),
+        )
+        self.connection.executemany(
+            "INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    sequence_id,
+                    match.start,
+                    match.end,
+                    match.length,
+                    match.match_break,
+                    match.amino_acid,
+                )
+                for match in matches
+            ],
+        )
+
+    def mark_largest_isoforms(self, sequence_ids):
+        """Flags the largest isoform of each gene, sequence_ids are in gene order."""
+        self.connection.executemany(
+            "UPDATE sequences SET largest_isoform = 1, gene_order = ? WHERE sequence_id = ?",
+            enumerate(sequence_ids),
+        )
+
+    def merge(self, part_paths):
+        """Copies the rows of the part reports of a sharded file and removes them."""
+        for part_path in part_paths:
+            self.connection.commit()
+            self.connection.execute("ATTACH DATABASE ? AS part", (part_path,))
+            self.connection.execute("INSERT INTO sequences SELECT * FROM part.sequences")
+            self.connection.execute("INSERT INTO matches SELECT * FROM part.matches")
+            self.connection.commit()
+            self.connection.execute("DETACH DATABASE part")
+            os.remove(part_path)
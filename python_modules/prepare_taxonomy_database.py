@@ -1,62 +1,322 @@
 import sqlite3
 import argparse
+import itertools
 import os
+import time
+
+import numpy as np
+
+from taxonomy_tree import TaxonomyTree, snapshot_path
+
+# Rows inserted per executemany call
+BATCH_SIZE = 100000
+
+# The database is built once from scratch into a temporary file, nothing needs to be
+# journaled or synced until it is complete
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",  # 256 MB, used when the indexes are sorted
+]
+
+# An update changes the database in place, it keeps the rollback journal so an
+# interrupted update leaves the previous database intact
+UPDATE_PRAGMAS = [
+    "PRAGMA cache_size = -262144",
+]
+
+# Columns matching a row of each table to the same row of a new taxdump
+TABLE_KEYS = {
+    "nodes": ["tax_id"],
+    "names": ["tax_id", "name_txt", "name_class"],
+}
+
+# Names are looked up ignoring case when checking for contamination, the NOCASE index
+# serves both these lookups and the prefix scans of the name suggestions
+NAME_INDEX = "CREATE INDEX IF NOT EXISTS idx_names_name_nocase ON names (name_txt COLLATE NOCASE)"
+
+# Ranks whose scientific names are stored for every tax ID in the ranks table,
+# the ones add_taxonomy_local can add to the headers
+MATERIALIZED_RANKS = ["species", "genus", "family", "order", "class", "phylum", "kingdom"]
+
+def parse_nodes(nodes_dmp):
+    """Yields (tax_id, parent_tax_id, rank) for every line of nodes.dmp."""
+    with open(nodes_dmp, "r") as file:
+        for line in file:
+            tax_id, parent_tax_id, rank, _ = line.split("\t|\t", 3)
+            yield int(tax_id), int(parent_tax_id), rank.strip()
+
+def parse_names(names_dmp):
+    """Yields (tax_id, name_txt, unique_name, name_class) for every line of names.dmp."""
+    with open(names_dmp, "r") as file:
+        for line in file:
+            tax_id, name_txt, unique_name, name_class = line.split("\t|\t")
+            yield int(tax_id), name_txt.strip(), unique_name.strip() or None, name_class.replace("|", "").strip()
+
+def parse_merged(merged_dmp):
+    """Yields (old_tax_id, new_tax_id) for every line of merged.dmp."""
+    with open(merged_dmp, "r") as file:
+        for line in file:
+            old_tax_id, new_tax_id, _ = line.split("\t|", 2)
+            yield int(old_tax_id), int(new_tax_id.strip())
+
+def parse_delnodes(delnodes_dmp):
+    """Yields the tax_id of every line of delnodes.dmp."""
+    with open(delnodes_dmp, "r") as file:
+        for line in file:
+            yield int(line.split("\t|", 1)[0])
+
+def load_rows(conn, insert, rows, table):
+    """Inserts the rows in batches of BATCH_SIZE, prints the load rate and returns the row count."""
+    start = time.perf_counter()
+    count = 0
+    for batch in iter(lambda: list(itertools.islice(rows, BATCH_SIZE)), []):
+        conn.executemany(insert, batch)
+        count += len(batch)
+    elapsed = time.perf_counter() - start
+    print(f"[DEBUG] Loaded {count} rows into {table} in {elapsed:.1f}s ({count / max(elapsed, 1e-6):.0f} rows/s).")
+    return count
+
+def lineage_rows(tree):
+    """Returns the (tax_id, left_index, right_index) rows of the lineage table, see compute_nested_sets."""
+    reached = tree.left_indices >= 0
+    return zip(
+        tree.tax_ids[reached].tolist(),
+        tree.left_indices[reached].tolist(),
+        tree.right_indices[reached].tolist(),
+    )
+
+def create_lineage_table(conn, tree):
+    """Stores the nested set interval of every node of the tree in the lineage table."""
+    conn.execute("""
+        CREATE TABLE lineage (
+            tax_id INTEGER PRIMARY KEY,
+            left_index INTEGER NOT NULL,
+            right_index INTEGER NOT NULL
+        )
+    """)
+    conn.executemany("INSERT INTO lineage (tax_id, left_index, right_index) VALUES (?, ?, ?)", lineage_rows(tree))
+
+def rank_rows(tree, positions=None):
+    """Returns the rows of the ranks table, the tax_id and the name of each MATERIALIZED_RANKS rank,
+    of the nodes at positions or of every node.
+
+    Ranks missing from a lineage are None, the names are the ones find_rank_names returns.
+    """
+    if positions is None:
+        positions = np.arange(len(tree.tax_ids))
+    rank_names = []
+    for rank in MATERIALIZED_RANKS:
+        rank_positions = tree.rank_positions(positions, rank)
+        # Names of higher ranks repeat for many tax IDs, each is decoded once
+        unique_positions, inverse = np.unique(rank_positions, return_inverse=True)
+        names = [
+            tree.scientific_name(position) if position >= 0 else None
+            for position in unique_positions.tolist()
+        ]
+        rank_names.append([names[index] for index in inverse.tolist()])
+    return zip(tree.tax_ids[positions].tolist(), *rank_names)
+
+def create_ranks_table(conn, tree):
+    """Stores the scientific name of each MATERIALIZED_RANKS rank on the lineage of every node, NULL when there is none."""
+    # order is an SQL keyword, every rank column is quoted
+    columns = [f'"{rank}"' for rank in MATERIALIZED_RANKS]
+    conn.execute(
+        f"CREATE TABLE ranks (tax_id INTEGER PRIMARY KEY, {', '.join(f'{column} TEXT' for column in columns)})"
+    )
+    conn.executemany(
+        f"INSERT INTO ranks (tax_id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+        rank_rows(tree),
+    )
+
+def stage_rows(conn, table, rows):
+    """Loads rows into temp.new_<table>, a table with the columns of table keyed by its TABLE_KEYS."""
+    # The column types are kept, comparisons with other types would not use the indexes
+    columns = [f'"{row[1]}" {row[2]}' for row in conn.execute(f"PRAGMA table_info({table})")]
+    keys = ", ".join(f'"{column}"' for column in TABLE_KEYS[table])
+    if TABLE_KEYS[table] == ["tax_id"]:
+        # The rows come sorted by tax_id, they are appended to the rowid
+        conn.execute(f"CREATE TEMP TABLE new_{table} (tax_id INTEGER PRIMARY KEY, {', '.join(columns[1:])})")
+        count = load_rows(conn, f"INSERT INTO new_{table} VALUES ({', '.join('?' * len(columns))})", rows, f"new_{table}")
+    else:
+        conn.execute(f"CREATE TEMP TABLE new_{table} ({', '.join(columns)})")
+        count = load_rows(conn, f"INSERT INTO new_{table} VALUES ({', '.join('?' * len(columns))})", rows, f"new_{table}")
+        conn.execute(f"CREATE INDEX temp.idx_new_{table} ON new_{table} ({keys})")
+    return count
+
+def apply_changes(conn, table):
+    """Makes table hold the rows staged in temp.new_<table>, writing only the rows that differ.
+
+    Rows are matched on their TABLE_KEYS, a row whose other columns changed is deleted
+    and inserted again. Returns the tax IDs of the rows removed or added.
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    keys = ", ".join(f'"{column}"' for column in TABLE_KEYS[table])
+    # Keys are compared with = so the indexes are used, IS also matches NULL columns
+    same_row = " AND ".join(
+        f'old."{column}" {"=" if column in TABLE_KEYS[table] else "IS"} new."{column}"'
+        for column in columns
+    )
+    conn.execute(f"CREATE TEMP TABLE stale_{table} AS SELECT {keys} FROM {table} AS old WHERE NOT EXISTS (SELECT 1 FROM new_{table} AS new WHERE {same_row})")
+    conn.execute(f"CREATE TEMP TABLE fresh_{table} AS SELECT * FROM new_{table} AS new WHERE NOT EXISTS (SELECT 1 FROM {table} AS old WHERE {same_row})")
+    removed = conn.execute(f"DELETE FROM {table} WHERE ({keys}) IN (SELECT {keys} FROM stale_{table})").rowcount
+    added = conn.execute(f"INSERT INTO {table} SELECT * FROM fresh_{table}").rowcount
+    changed_tax_ids = [row[0] for row in conn.execute(f"SELECT tax_id FROM stale_{table} UNION SELECT tax_id FROM fresh_{table}")]
+    for temporary_table in (f"new_{table}", f"stale_{table}", f"fresh_{table}"):
+        conn.execute(f"DROP TABLE temp.{temporary_table}")
+    print(f"[DEBUG] Updated {table}: {removed} rows removed or changed, {added} added or changed.")
+    return changed_tax_ids
+
+def update_ranks_table(conn, tree, changed_tax_ids):
+    """Rewrites the ranks of the nodes whose lineage passes through a changed node, removes the ones of deleted nodes."""
+    positions = tree.positions(changed_tax_ids)
+    removed = [(tax_id,) for tax_id, position in zip(changed_tax_ids, positions.tolist()) if position < 0]
+    conn.executemany("DELETE FROM ranks WHERE tax_id = ?", removed)
+
+    affected = tree.subtree_positions(changed_tax_ids)
+    columns = [f'"{rank}"' for rank in MATERIALIZED_RANKS]
+    conn.executemany(
+        f"INSERT OR REPLACE INTO ranks (tax_id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+        rank_rows(tree, affected),
+    )
+    print(f"[DEBUG] Updated ranks: {len(removed)} rows removed, {len(affected)} rewritten.")
+
+def report_removed_nodes(conn, merged_dmp=None, delnodes_dmp=None):
+    """Prints how many nodes are not in the new nodes.dmp, and how many of them merged.dmp and delnodes.dmp account for."""
+    removed = {row[0] for row in conn.execute("SELECT tax_id FROM nodes WHERE tax_id NOT IN (SELECT tax_id FROM new_nodes)")}
+    merged = {old_tax_id for old_tax_id, _ in parse_merged(merged_dmp)} if merged_dmp else set()
+    deleted = set(parse_delnodes(delnodes_dmp)) if delnodes_dmp else set()
+    print(f"[DEBUG] {len(removed)} tax IDs removed, {len(removed & merged)} merged into other taxa, {len(removed & deleted)} deleted.")
+    unlisted = removed - merged - deleted
+    if (merged_dmp or delnodes_dmp) and unlisted:
+        print(f"[Warning] {len(unlisted)} removed tax IDs are neither in merged.dmp nor in delnodes.dmp, the dump may not follow the database release.")
+
+def update_database_from_dmp(nodes_dmp="nodes.dmp", names_dmp="names.dmp", db_file="taxonomy.db", merged_dmp=None, delnodes_dmp=None):
+    """Updates an existing taxonomy database in place to a newer NCBI taxdump.
+
+    The new .dmp files are loaded into temporary tables and diffed against nodes and
+    names, only the inserted, changed and deleted rows are written. nodes.dmp lists
+    every current node, so it decides which nodes are removed, merged.dmp and
+    delnodes.dmp account for them. The tree is rebuilt from the updated tables, the
+    lineage table is written again and the ranks of the subtrees of changed nodes
+    are rewritten, then the tree snapshot is saved again. Everything is applied in
+    one transaction.
+    """
+    if not os.path.exists(db_file):
+        print(f"[DEBUG] No database to update at {db_file}, building it from the .dmp files.")
+        create_database_from_dmp(nodes_dmp, names_dmp, db_file)
+        return
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    for pragma in UPDATE_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("BEGIN")
+
+    stage_rows(conn, "nodes", parse_nodes(nodes_dmp))
+    report_removed_nodes(conn, merged_dmp, delnodes_dmp)
+    changed_tax_ids = apply_changes(conn, "nodes")
+    stage_rows(conn, "names", parse_names(names_dmp))
+    changed_tax_ids = sorted(set(changed_tax_ids).union(apply_changes(conn, "names")))
+    # Only databases built by the bulk loader before names were indexed ignoring case
+    # have idx_names_name_txt, released databases had no index on name_txt at all
+    conn.execute("DROP INDEX IF EXISTS idx_names_name_txt")
+    conn.execute(NAME_INDEX)
+
+    tree = None
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if changed_tax_ids or not {"lineage", "ranks"} <= tables:
+        lineage_start = time.perf_counter()
+        tree = TaxonomyTree.from_connection(conn)
+        # Moving or adding a node renumbers the intervals of every node after it, the lineage table is written whole
+        conn.execute("DROP TABLE IF EXISTS lineage")
+        create_lineage_table(conn, tree)
+        # Databases built before the ranks table existed get it whole
+        if "ranks" in tables:
+            update_ranks_table(conn, tree, changed_tax_ids)
+        else:
+            create_ranks_table(conn, tree)
+        print(f"[DEBUG] Updated the lineage intervals and ranks of {len(tree.tax_ids)} nodes in {time.perf_counter() - lineage_start:.1f}s.")
+    conn.execute("COMMIT")
+    conn.close()
+
+    if tree is None:
+        TaxonomyTree.open(db_file)  # only built if the snapshot is missing or stale
+    else:
+        tree.save(snapshot_path(db_file), db_file)
+    print(f"[DEBUG] SQLite database updated from .dmp files in {time.perf_counter() - start:.1f}s.")
 
 def create_database_from_dmp(nodes_dmp="nodes.dmp", names_dmp="names.dmp", db_file="taxonomy.db"):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
+    """Builds the taxonomy database from the NCBI taxdump files in a single transaction.
+
+    Rows are streamed from the .dmp files through executemany, the names indexes are
+    only built once every row is loaded, then the file replaces db_file.
+    The lineage table holds the nested set interval of every node, see compute_nested_sets,
+    the ranks table the names of the MATERIALIZED_RANKS on its lineage, and the snapshot
+    of TaxonomyTree is saved next to the database.
+    """
+    start = time.perf_counter()
+    temporary_db_file = f"{db_file}.tmp"
+    if os.path.exists(temporary_db_file):
+        os.remove(temporary_db_file)
 
-    # Drop existing tables if they exist
-    cursor.execute("DROP TABLE IF EXISTS nodes")
-    cursor.execute("DROP TABLE IF EXISTS names")
+    conn = sqlite3.connect(temporary_db_file, isolation_level=None)
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("BEGIN")
 
-    # Create tables for nodes and names
-    cursor.execute("""
+    # tax_id is the rowid of nodes, no other index is needed to walk up the tree
+    conn.execute("""
         CREATE TABLE nodes (
             tax_id INTEGER PRIMARY KEY,
             parent_tax_id INTEGER,
             rank TEXT
         )
     """)
-    
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE names (
             tax_id INTEGER,
             name_txt TEXT,
             unique_name TEXT,
-            name_class TEXT,
-            PRIMARY KEY (tax_id, name_txt, name_class)
+            name_class TEXT
         )
     """)
 
-    # Load nodes.dmp into nodes table
-    with open(nodes_dmp, "r") as file:
-        for line in file:
-            fields = line.strip().split("\t|\t")
-            tax_id = int(fields[0].strip())
-            parent_tax_id = int(fields[1].strip())
-            rank = fields[2].strip()
-            cursor.execute("INSERT INTO nodes (tax_id, parent_tax_id, rank) VALUES (?, ?, ?)", 
-                           (tax_id, parent_tax_id, rank))
-
-    # Load names.dmp into names table
-    with open(names_dmp, "r") as file:
-        for line in file:
-            fields = line.strip().split("\t|\t")
-            tax_id = int(fields[0].strip())
-            name_txt = fields[1].strip()
-            unique_name = fields[2].strip() if fields[2].strip() else None
-            name_class = fields[3].replace("|", "").strip()
-            cursor.execute("INSERT INTO names (tax_id, name_txt, unique_name, name_class) VALUES (?, ?, ?, ?)",
-                           (tax_id, name_txt, unique_name, name_class))
-
-    # Commit and create indexes to speed up queries
-    conn.commit()
-    cursor.execute("CREATE INDEX idx_nodes_tax_id ON nodes (tax_id)")
-    cursor.execute("CREATE INDEX idx_names_tax_id ON names (tax_id)")
-    conn.commit()
+    rows = load_rows(
+        conn,
+        "INSERT INTO nodes (tax_id, parent_tax_id, rank) VALUES (?, ?, ?)",
+        parse_nodes(nodes_dmp),
+        "nodes",
+    )
+    rows += load_rows(
+        conn,
+        "INSERT INTO names (tax_id, name_txt, unique_name, name_class) VALUES (?, ?, ?, ?)",
+        parse_names(names_dmp),
+        "names",
+    )
+
+    # The unique index keeps the former primary key of names and serves lookups by tax_id,
+    # names are looked up by name_txt when checking for contamination, see NAME_INDEX
+    conn.execute("CREATE UNIQUE INDEX idx_names_tax_id ON names (tax_id, name_txt, name_class)")
+    conn.execute(NAME_INDEX)
+
+    # The scientific names of the tree are read through the names index
+    lineage_start = time.perf_counter()
+    tree = TaxonomyTree.from_connection(conn)
+    create_lineage_table(conn, tree)
+    create_ranks_table(conn, tree)
+    print(f"[DEBUG] Built the taxonomy tree, lineage intervals and ranks of {len(tree.tax_ids)} nodes in {time.perf_counter() - lineage_start:.1f}s.")
+    conn.execute("COMMIT")
     conn.close()
-    print("[DEBUG] SQLite database created from .dmp files.")
+    os.replace(temporary_db_file, db_file)
+
+    # Snapshot of the tree for the array backend, it is tied to the final database file
+    tree.save(snapshot_path(db_file), db_file)
+
+    elapsed = time.perf_counter() - start
+    print(f"[DEBUG] SQLite database created from .dmp files, {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-6):.0f} rows/s).")
 
 if __name__ == '__main__':
     # Valid ranks to check against the database
@@ -66,11 +326,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Add family taxonomy to FASTA headers.')
     parser.add_argument("-id", "--input_directory", help="Directory containing input files", required=True)
     parser.add_argument("-od", "--output_directory", help="Directory for output files", required=True)
+    parser.add_argument("-u", "--update", help="Update the taxonomy.db of the output directory in place instead of building it from scratch", required=False, default="False", choices=["True", "true", "False", "false"])
     args = parser.parse_args()
 
     nodes_path = os.path.join(args.input_directory, "nodes.dmp")
     names_path = os.path.join(args.input_directory, "names.dmp")
+    merged_path = os.path.join(args.input_directory, "merged.dmp")
+    delnodes_path = os.path.join(args.input_directory, "delnodes.dmp")
     taxonomy_path = os.path.join(args.output_directory, "taxonomy.db")
 
-    # Example usage
-    create_database_from_dmp(nodes_path, names_path, taxonomy_path)
+    if args.update.capitalize() == "True":
+        update_database_from_dmp(
+            nodes_path,
+            names_path,
+            taxonomy_path,
+            merged_path if os.path.exists(merged_path) else None,
+            delnodes_path if os.path.exists(delnodes_path) else None,
+        )
+    else:
+        create_database_from_dmp(nodes_path, names_path, taxonomy_path)
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+
+from taxonomy_tree import TaxonomyTree, database_signature
+
+# Seconds without connected clients after which a service stops, 0 keeps it running
+DEFAULT_IDLE_TIMEOUT = 600
+
+# Seconds a served request waits for the next one before checking whether to stop
+POLL_INTERVAL = 1
+
+
+def socket_path(db_file):
+    return f"{db_file}.sock"
+
+
+class TaxonomyService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Keeps the taxonomy tree of a database in memory and answers queries on a Unix socket.
+
+    Requests and responses are JSON objects, one per line, and a client keeps its
+    connection for as many requests as it needs. Every query takes many tax IDs
+    at once. The database is checked before each request, and the tree is loaded
+    again when prepare_taxonomy_database rebuilt or updated it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, db_file, path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.db_file = os.path.abspath(db_file)
+        self.idle_timeout = idle_timeout
+        self.timeout = POLL_INTERVAL
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.last_request = time.monotonic()
+        self.stopping = False
+        self.load()
+        super().__init__(path, TaxonomyRequestHandler)
+
+    def load(self):
+        self.signature = database_signature(self.db_file)
+        self.tree = TaxonomyTree.open(self.db_file)
+
+    def current_tree(self):
+        """Returns the tree, loaded again when the database changed since it was loaded."""
+        with self.lock:
+            self.last_request = time.monotonic()
+            if database_signature(self.db_file) != self.signature:
+                print(f"Reloading the taxonomy tree of {self.db_file}.")
+                self.load()
+            return self.tree
+
+    def answer(self, request):
+        operation = request.get("op")
+        if operation == "ping":
+            return {"database": self.db_file}
+        if operation == "shutdown":
+            self.stopping = True
+            return None
+
+        tree = self.current_tree()
+        if operation == "rank_names":
+            tax_ids = request["tax_ids"]
+            positions = tree.positions(tax_ids)
+            return {
+                "rank_names": tree.find_rank_names_batch(tax_ids, request["ranks"]),
+                "missing": [tax_id for tax_id, position in zip(tax_ids, positions.tolist()) if position < 0],
+            }
+        if operation == "descends_from":
+            return tree.descends_from(request["tax_ids"], request["ancestors"]).tolist()
+        if operation == "lineage":
+            return [tree.lineage(tax_id) for tax_id in request["tax_ids"]]
+        raise ValueError(f"Unknown operation {operation!r}")
+
+    def is_idle(self):
+        with self.lock:
+            return (
+                self.idle_timeout > 0
+                and self.clients == 0
+                and time.monotonic() - self.last_request > self.idle_timeout
+            )
+
+    def serve(self):
+        """Answers requests until a shutdown request, or until it was idle for idle_timeout seconds."""
+        print(f"Taxonomy service of {self.db_file} listening on {self.server_address}.")
+        try:
+            while not self.stopping and not self.is_idle():
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+        print("Taxonomy service stopped.")
+
+
+class TaxonomyRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.clients += 1
+        try:
+            for line in self.rfile:
+                try:
+                    response = {"result": self.server.answer(json.loads(line))}
+                except (AttributeError, KeyError, TypeError, ValueError) as error:
+                    response = {"error": f"{type(error).__name__}: {error}"}
+                self.wfile.write((json.dumps(response) + "\n").encode())
+        finally:
+            with self.server.lock:
+                self.server.clients -= 1
+                self.server.last_request = time.monotonic()
+
+
+class TaxonomyClient:
+    """Queries a running taxonomy service, with the lineage methods of TaxonomyTree."""
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.stream = self.socket.makefile("rwb")
+
+    def request(self, operation, **arguments):
+        self.stream.write((json.dumps({"op": operation, **arguments}) + "\n").encode())
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("The taxonomy service closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Taxonomy service: {response['error']}")
+        return response["result"]
+
+    def find_rank_names_batch(self, tax_ids, ranks):
+        """Returns the rank names of every tax ID, like TaxonomyTree.find_rank_names_batch."""
+        result = self.request("rank_names", tax_ids=[int(tax_id) for tax_id in tax_ids], ranks=ranks)
+        for tax_id in result["missing"]:
+            print(f"[Warning] Tax ID {tax_id} not found in nodes table.")
+        return result["rank_names"]
+
+    def find_rank_names(self, tax_id, ranks):
+        return self.find_rank_names_batch([tax_id], ranks)[0]
+
+    def descends_from(self, tax_ids, ancestor_tax_ids):
+        """Returns, for each tax ID, whether it descends from one of ancestor_tax_ids."""
+        return np.array(
+            self.request(
+                "descends_from",
+                tax_ids=[int(tax_id) for tax_id in tax_ids],
+                ancestors=[int(tax_id) for tax_id in ancestor_tax_ids],
+            ),
+            dtype=bool,
+        )
+
+    def lineages(self, tax_ids):
+        """Returns the lineage of every tax ID, see TaxonomyTree.lineage."""
+        return [
+            [tuple(node) for node in lineage]
+            for lineage in self.request("lineage", tax_ids=[int(tax_id) for tax_id in tax_ids])
+        ]
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+def connect_service(db_file, path=None):
+    """Returns a client of the service of db_file when one is running, None otherwise."""
+    path = path or socket_path(db_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        client = TaxonomyClient(path)
+    except OSError:
+        return None  # a socket left by a service that did not stop cleanly
+    try:
+        served = client.request("ping")
+    except (OSError, ValueError, RuntimeError):
+        client.close()
+        return None
+    if served["database"] != os.path.abspath(db_file):
+        client.close()
+        return None
+    return client
+
+
+def stop_service(db_file, path=None):
+    client = connect_service(db_file, path)
+    if client is None:
+        print("No taxonomy service is running.")
+        return
+    client.request("shutdown")
+    client.close()
+    print("Taxonomy service asked to stop.")
+
+
+def start_service(db_file, path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, detach=False):
+    """Serves db_file on path, unless a service of it already runs there.
+
+    With detach the tree is loaded and the socket bound before the process forks,
+    so the service accepts connections as soon as this returns.
+    """
+    path = path or socket_path(db_file)
+    client = connect_service(db_file, path)
+    if client is not None:
+        client.close()
+        print(f"A taxonomy service of {db_file} is already listening on {path}.")
+        return
+    # A socket left by a service that did not stop cleanly is replaced
+    if os.path.exists(path):
+        os.remove(path)
+    service = TaxonomyService(db_file, path, idle_timeout)
+    sys.stdout.flush()  # not to print the output buffered so far twice
+    if detach and os.fork() > 0:
+        service.socket.close()  # only the child serves
+        return
+    if detach:
+        os.setsid()
+    service.serve()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serves the taxonomy tree of a database on a Unix socket, for add_taxonomy and check_contamination."
+    )
+    parser.add_argument(
+        "-db", "--database_file", help="Path to SQLite database file", required=True
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        help="Path of the Unix socket, the database path with a .sock suffix by default",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "-it",
+        "--idle_timeout",
+        help="Seconds without clients after which the service stops, 0 to keep it running",
+        required=False,
+        default=DEFAULT_IDLE_TIMEOUT,
+        type=int,
+    )
+    parser.add_argument(
+        "-d",
+        "--detach",
+        help="Serve in the background, returning once the service accepts connections",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    parser.add_argument(
+        "-st",
+        "--stop",
+        help="Stop the running service instead of starting one",
+        required=False,
+        default="False",
+        choices=["True", "true", "False", "false"],
+    )
+    args = parser.parse_args()
+
+    if args.stop.capitalize() == "True":
+        stop_service(args.database_file, args.socket)
+    else:
+        start_service(
+            args.database_file,
+            args.socket,
+            args.idle_timeout,
+            args.detach.capitalize() == "True",
+        )
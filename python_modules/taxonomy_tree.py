@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+
+# Arrays of a snapshot, each saved as <name>.npy
+SNAPSHOT_ARRAYS = [
+    "tax_ids",
+    "parents",
+    "rank_codes",
+    "left_indices",
+    "right_indices",
+    "name_offsets",
+    "names",
+]
+
+
+def compute_nested_sets(tax_ids, parent_tax_ids):
+    """Numbers the nodes in depth first order, returns the left and right index of every node.
+
+    A node descends from another when its left index falls in the other's
+    (left_index, right_index] interval. Nodes that are their own parent, like the
+    NCBI root, or whose parent is missing start a tree. Nodes in a cycle are never
+    reached and keep a left index of -1.
+    """
+    tax_ids = np.asarray(tax_ids, dtype=np.int64)
+    parent_tax_ids = np.asarray(parent_tax_ids, dtype=np.int64)
+    parent_positions, is_root = parent_positions_of(tax_ids, parent_tax_ids)
+
+    # Children of each node are contiguous in children, from offsets[node] to offsets[node + 1]
+    child_positions = np.flatnonzero(~is_root)
+    children = child_positions[np.argsort(parent_positions[child_positions], kind="stable")]
+    offsets = np.searchsorted(
+        parent_positions[children], np.arange(len(tax_ids) + 1)
+    ).tolist()
+    children = children.tolist()
+
+    left_indices = [-1] * len(tax_ids)
+    subtree_sizes = [1] * len(tax_ids)
+    visit_order = []
+    for root in np.flatnonzero(is_root).tolist():
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            left_indices[node] = len(visit_order)
+            visit_order.append(node)
+            stack.extend(children[offsets[node] : offsets[node + 1]])
+
+    # Every child is visited after its parent, sizes add up in reverse order
+    parent_positions = parent_positions.tolist()
+    is_root = is_root.tolist()
+    for node in reversed(visit_order):
+        if not is_root[node]:
+            subtree_sizes[parent_positions[node]] += subtree_sizes[node]
+
+    left_indices = np.array(left_indices, dtype=np.int64)
+    right_indices = left_indices + np.array(subtree_sizes, dtype=np.int64) - 1
+    return left_indices, right_indices
+
+
+def parent_positions_of(tax_ids, parent_tax_ids):
+    """Returns the position of the parent of every node in tax_ids and whether it starts a tree."""
+    order = np.argsort(tax_ids, kind="stable")
+    parent_positions = order[
+        np.minimum(np.searchsorted(tax_ids, parent_tax_ids, sorter=order), len(tax_ids) - 1)
+    ]
+    is_root = (tax_ids[parent_positions] != parent_tax_ids) | (parent_tax_ids == tax_ids)
+    return parent_positions, is_root
+
+
+def snapshot_path(db_file):
+    return f"{db_file}.tree"
+
+
+def database_signature(db_file):
+    stat = os.stat(db_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TaxonomyTree:
+    """Taxonomy held in dense NumPy arrays indexed by node position, nodes are sorted by tax ID.
+
+    parents holds the position of the parent of each node (roots are their own
+    parent), rank_codes indexes the ranks list and the scientific name of node i is
+    names[name_offsets[i]:name_offsets[i + 1]]. left_indices and right_indices are
+    the nested set intervals of compute_nested_sets.
+
+    The arrays are saved next to the database as a snapshot of .npy files that are
+    memory mapped when loaded, so processes reading the same snapshot share its pages.
+    Lineage walks are array indexing, and every query takes many tax IDs at once.
+    """
+
+    def __init__(self, arrays, ranks):
+        for name in SNAPSHOT_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.ranks = ranks
+        self.rank_code = {rank: code for code, rank in enumerate(ranks)}
+
+    @classmethod
+    def from_database(cls, db_file):
+        """Builds the arrays from the nodes and names tables of a taxonomy database."""
+        conn = sqlite3.connect(db_file)
+        tree = cls.from_connection(conn)
+        conn.close()
+        return tree
+
+    @classmethod
+    def from_connection(cls, conn):
+        tax_ids, parent_tax_ids, ranks = zip(
+            *conn.execute("SELECT tax_id, parent_tax_id, rank FROM nodes ORDER BY tax_id")
+        )
+        # The first scientific name in index order, the one find_rank_names reads
+        scientific_names = dict(
+            conn.execute(
+                "SELECT tax_id, MIN(name_txt) FROM names"
+                " WHERE name_class = 'scientific name' GROUP BY tax_id"
+            )
+        )
+
+        tax_ids = np.array(tax_ids, dtype=np.int64)
+        parent_tax_ids = np.array(parent_tax_ids, dtype=np.int64)
+        parent_positions, is_root = parent_positions_of(tax_ids, parent_tax_ids)
+        left_indices, right_indices = compute_nested_sets(tax_ids, parent_tax_ids)
+        # Nodes in a cycle become roots, so every walk up the tree ends
+        parents = np.where(
+            is_root | (left_indices < 0), np.arange(len(tax_ids)), parent_positions
+        ).astype(np.int32)
+
+        rank_list = sorted(set(ranks))
+        rank_code = {rank: code for code, rank in enumerate(rank_list)}
+        encoded_names = [
+            scientific_names.get(tax_id, "").encode() for tax_id in tax_ids.tolist()
+        ]
+        name_offsets = np.zeros(len(tax_ids) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+
+        arrays = {
+            "tax_ids": tax_ids,
+            "parents": parents,
+            "rank_codes": np.array([rank_code[rank] for rank in ranks], dtype=np.uint8),
+            "left_indices": left_indices,
+            "right_indices": right_indices,
+            "name_offsets": name_offsets,
+            "names": np.frombuffer(b"".join(encoded_names), dtype=np.uint8),
+        }
+        return cls(arrays, rank_list)
+
+    def save(self, path, db_file):
+        """Writes the snapshot to the path directory, replacing any earlier one.
+
+        The snapshot is written to a temporary directory renamed to path, which is
+        removed again when the rename fails, e.g. when another process saving the
+        same snapshot renamed its own first.
+        """
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(temporary_path)
+            for name in SNAPSHOT_ARRAYS:
+                np.save(os.path.join(temporary_path, f"{name}.npy"), getattr(self, name))
+            with open(os.path.join(temporary_path, "meta.json"), "w") as meta_file:
+                json.dump(
+                    {
+                        "version": SNAPSHOT_VERSION,
+                        "database": database_signature(db_file),
+                        "ranks": self.ranks,
+                    },
+                    meta_file,
+                )
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.rename(temporary_path, path)
+        except OSError:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path, db_file=None):
+        """Memory maps a snapshot, returns None if there is none or it was built from another version of db_file."""
+        try:
+            with open(os.path.join(path, "meta.json"), "r") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != SNAPSHOT_VERSION:
+            return None
+        if db_file is not None and meta["database"] != database_signature(db_file):
+            return None
+        try:
+            arrays = {
+                name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                for name in SNAPSHOT_ARRAYS
+            }
+        except (OSError, ValueError):
+            return None  # being replaced by another process
+        return cls(arrays, meta["ranks"])
+
+    @classmethod
+    def open(cls, db_file):
+        """Loads the snapshot of db_file, building it first when it is missing or stale.
+
+        When the snapshot can not be saved the tree built in memory is returned, and
+        when another process saved it first its snapshot is loaded.
+        """
+        path = snapshot_path(db_file)
+        tree = cls.load(path, db_file)
+        if tree is None:
+            print(f"Building the taxonomy tree snapshot {path}.")
+            tree = cls.from_database(db_file)
+            try:
+                tree.save(path, db_file)
+            except OSError:
+                pass  # read-only directory, or another process saved it first
+            tree = cls.load(path, db_file) or tree
+        return tree
+
+    def close(self):
+        pass  # the memory maps are released with the arrays
+
+    def positions(self, tax_ids):
+        """Returns the position of every tax ID, -1 for the ones not in the tree."""
+        tax_ids = np.array([int(tax_id) for tax_id in tax_ids], dtype=np.int64)
+        if not len(self.tax_ids):
+            return np.full(len(tax_ids), -1)
+        positions = np.minimum(np.searchsorted(self.tax_ids, tax_ids), len(self.tax_ids) - 1)
+        return np.where(self.tax_ids[positions] == tax_ids, positions, -1)
+
+    def scientific_name(self, position):
+        start, end = self.name_offsets[position], self.name_offsets[position + 1]
+        return bytes(self.names[start:end]).decode()
+
+    def rank_positions(self, positions, rank):
+        """Returns, for each position, the closest node of rank with a scientific name
+        on its lineage (itself included), -1 when there is none."""
+        found = np.full(len(positions), -1)
+        if rank not in self.rank_code:
+            return found
+        code = self.rank_code[rank]
+
+        # Every pending lineage moves one level up per step, until it is found or reaches a root
+        pending = np.flatnonzero(positions >= 0)
+        current = positions[pending]
+        while pending.size:
+            hit = (self.rank_codes[current] == code) & (
+                self.name_offsets[current + 1] > self.name_offsets[current]
+            )
+            found[pending[hit]] = current[hit]
+            parents = self.parents[current]
+            climbing = ~hit & (parents != current)
+            pending = pending[climbing]
+            current = parents[climbing]
+        return found
+
+    def find_rank_names_batch(self, tax_ids, ranks):
+        """Returns the rank names of every tax ID, like find_rank_names."""
+        positions = self.positions(tax_ids)
+        rank_names = [{rank: "Name not found" for rank in ranks} for _ in tax_ids]
+        for rank in dict.fromkeys(ranks):
+            for index, position in enumerate(self.rank_positions(positions, rank).tolist()):
+                if position >= 0:
+                    rank_names[index][rank] = self.scientific_name(position)
+        return rank_names
+
+    def position(self, tax_id):
+        """Returns the position of one tax ID, -1 if it is not in the tree."""
+        tax_id = int(tax_id)
+        position = int(np.searchsorted(self.tax_ids, tax_id))
+        if position < len(self.tax_ids) and self.tax_ids[position] == tax_id:
+            return position
+        return -1
+
+    def find_rank_names(self, tax_id, ranks):
+        """Returns {rank: scientific name} of the lineage of tax_id, "Name not found" for the missing ranks.
+
+        A single lineage is walked with scalar indexing, see find_rank_names_batch for many.
+        """
+        rank_names = {rank: "Name not found" for rank in ranks}
+        position = self.position(tax_id)
+        if position < 0:
+            print(f"[Warning] Tax ID {tax_id} not found in nodes table.")
+            return rank_names
+
+        wanted = {self.rank_code[rank]: rank for rank in ranks if rank in self.rank_code}
+        while wanted:
+            code = int(self.rank_codes[position])
+            if code in wanted and self.name_offsets[position + 1] > self.name_offsets[position]:
+                rank_names[wanted.pop(code)] = self.scientific_name(position)
+            parent = int(self.parents[position])
+            if parent == position:
+                break
+            position = parent
+        return rank_names
+
+    def lineage(self, tax_id):
+        """Returns the (tax_id, rank, scientific name) of tax_id and of its ancestors up to the root, empty if it is not in the tree."""
+        lineage = []
+        position = self.position(tax_id)
+        while position >= 0:
+            lineage.append(
+                (
+                    int(self.tax_ids[position]),
+                    self.ranks[self.rank_codes[position]],
+                    self.scientific_name(position),
+                )
+            )
+            parent = int(self.parents[position])
+            position = -1 if parent == position else parent
+        return lineage
+
+    def subtree_positions(self, tax_ids):
+        """Returns the positions of the nodes of tax_ids and of every node descending from them."""
+        positions = self.positions(tax_ids)
+        positions = positions[positions >= 0]
+        # Subtrees are the left index ranges [left_index, right_index], they are marked
+        # in a difference array over left indices
+        reached = positions[self.left_indices[positions] >= 0]
+        boundaries = np.zeros(len(self.tax_ids) + 1, dtype=np.int64)
+        np.add.at(boundaries, self.left_indices[reached], 1)
+        np.add.at(boundaries, self.right_indices[reached] + 1, -1)
+        covered = np.cumsum(boundaries[:-1]) > 0
+        in_subtree = np.flatnonzero((self.left_indices >= 0) & covered[np.maximum(self.left_indices, 0)])
+        return np.union1d(in_subtree, positions)
+
+    def descends_from(self, tax_ids, ancestor_tax_ids):
+        """Returns, for each tax ID, whether it descends from one of ancestor_tax_ids."""
+        positions = self.positions(tax_ids)
+        left_indices = np.where(positions >= 0, self.left_indices[positions], -1)
+        matches = np.zeros(len(positions), dtype=bool)
+        for ancestor in self.positions(ancestor_tax_ids).tolist():
+            if ancestor >= 0 and self.left_indices[ancestor] >= 0:
+                matches |= (left_indices > self.left_indices[ancestor]) & (
+                    left_indices <= self.right_indices[ancestor]
+                )
+        return matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds the memory mapped taxonomy tree snapshot of a taxonomy database."
+    )
+    parser.add_argument(
+        "-db", "--database_file", help="Path to SQLite database file", required=True
+    )
+    args = parser.parse_args()
+
+    TaxonomyTree.from_database(args.database_file).save(
+        snapshot_path(args.database_file), args.database_file
+    )
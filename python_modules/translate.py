@@ -1,41 +1,193 @@
-import sys
-from Bio import SeqIO
+import argparse
+import functools
+import re
+
+import numpy as np
+from Bio.Data.CodonTable import standard_dna_table
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+
+from compression import open_input, open_output
+from poly_detector import batched
+from translation_cache import DEFAULT_MAX_SIZE, TranslationCache
+
+# Index of each base in a codon, the sequence bytes are mapped through it,
+# codons with anything but ACGT (either case) are left to Biopython
+NUCLEOTIDES = "TCAG"
+INVALID_BASE = 255
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for code, base in enumerate(NUCLEOTIDES):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.lower())] = code
+
+# Amino acid of the 64 codons of the standard table, indexed by 16 * first + 4 * second + third base
+CODON_TABLE = np.frombuffer(
+    "".join(
+        standard_dna_table.forward_table.get(first + second + third, "*")
+        for first in NUCLEOTIDES
+        for second in NUCLEOTIDES
+        for third in NUCLEOTIDES
+    ).encode("ascii"),
+    dtype=np.uint8,
+)
+
+# Codons made of these never raise an error, Biopython translates them one by one.
+# Codons with other characters (e.g. gaps) fall back to translating the whole sequence,
+# since Biopython only raises for them when they come before the first stop codon
+AMBIGUOUS_CODON_PATTERN = re.compile(r"[ACGTURYSWKMBDHVN]{3}", re.IGNORECASE)
+
+# Line width of the translated fasta files, the one of Bio.SeqIO
+FASTA_LINE_WIDTH = 60
+
+# Translation cache modes of translate_sequence, proteins up to the first stop codon,
+# and of translate_sequence_transeq
+CACHE_MODE = "standard_to_stop"
+TRANSEQ_CACHE_MODE = "transeq_trim"
+
+
+def translate_sequence_biopython(nucleotide_sequence):
+    """Translates a nucleotide string up to the first stop codon, returns the protein string."""
+    seq = Seq(nucleotide_sequence)
+    # Trim the sequence length to the nearest length divisible by 3
+    trimmed_seq = seq[: len(seq) - (len(seq) % 3)]
+    # Translate the trimmed nucleic acid sequence to a protein sequence
+    protein_seq = trimmed_seq.translate(to_stop=True)
+    # Remove stop codons ('*') from the protein sequence
+    return str(protein_seq).replace("*", "")
+
+
+@functools.lru_cache(maxsize=None)
+def translate_ambiguous_codon(codon):
+    return str(Seq(codon).translate())
+
+
+def translate_codons(nucleotide_sequence, invalid_codon=None):
+    """Returns the amino acids of every full codon as bytes, stop codons included.
+
+    Codons are looked up in CODON_TABLE over a NumPy view of the sequence, codons with
+    ambiguous bases are translated by Biopython. Codons with other characters are
+    translated to invalid_codon, or None is returned when it is not given.
+    """
+    data = nucleotide_sequence.encode("ascii", "replace")
+    codes = BASE_CODES[
+        np.frombuffer(data, dtype=np.uint8, count=len(data) // 3 * 3)
+    ].reshape(-1, 3)
+    # Codons with an invalid base get a wrong index here, they are replaced below
+    protein = CODON_TABLE[(codes[:, 0] * 16 + codes[:, 1] * 4 + codes[:, 2]) & 63]
+
+    if codes.size and codes.max() == INVALID_BASE:
+        for index in np.flatnonzero((codes == INVALID_BASE).any(axis=1)).tolist():
+            codon = nucleotide_sequence[3 * index : 3 * index + 3]
+            if AMBIGUOUS_CODON_PATTERN.fullmatch(codon):
+                protein[index] = ord(translate_ambiguous_codon(codon.upper()))
+            elif invalid_codon is None:
+                return None
+            else:
+                protein[index] = ord(invalid_codon)
+    return protein.tobytes()
+
+
+def translate_sequence(nucleotide_sequence):
+    """Translates a nucleotide string up to the first stop codon, returns the protein string.
+
+    Same result as translate_sequence_biopython, which is only used for sequences with
+    characters that are not IUPAC bases.
+    """
+    protein = translate_codons(nucleotide_sequence)
+    if protein is None:
+        return translate_sequence_biopython(nucleotide_sequence)
+    stop = protein.find(b"*")
+    return (protein if stop == -1 else protein[:stop]).decode("ascii")
+
+
+def translate_sequence_transeq(nucleotide_sequence):
+    """Translates a nucleotide string like EMBOSS transeq -trim, returns the protein string.
+
+    Every codon is translated, stop codons as '*' and codons that can not be translated as 'X'.
+    A final codon of two bases is translated when they are enough to tell the amino acid,
+    then the trailing 'X' and '*' are trimmed.
+    """
+    protein = translate_codons(nucleotide_sequence, invalid_codon="X").decode("ascii")
+    if len(nucleotide_sequence) % 3 == 2:
+        protein += translate_codons(nucleotide_sequence[-2:] + "N", "X").decode("ascii")
+    return protein.rstrip("X*")
+
+
+def transeq_title(title):
+    """Returns the header transeq gives to the translation of a record, frame 1 is appended to the ID."""
+    identifier, _, description = title.partition(" ")
+    return f"{identifier}_1 {description}" if description else f"{identifier}_1"
+
+
+def format_fasta(title, sequence):
+    """Returns a fasta record wrapped like Bio.SeqIO writes it."""
+    lines = [f">{title}"]
+    lines.extend(
+        sequence[start : start + FASTA_LINE_WIDTH]
+        for start in range(0, len(sequence), FASTA_LINE_WIDTH)
+    )
+    return "\n".join(lines) + "\n"
 
 
-def translate_fasta_no_header_change(input_path, output_path):
-    translated_records = []
+def translate_fasta_no_header_change(
+    input_path, output_path, translation_cache=None, translation_cache_size=DEFAULT_MAX_SIZE
+):
+    """Translates a plain or gzip fasta file, output paths ending in .gz are written compressed.
 
-    for record in SeqIO.parse(input_path, "fasta"):
-        # Trim the sequence length to the nearest length divisible by 3
-        trimmed_seq = record.seq[: len(record.seq) - (len(record.seq) % 3)]
-        # Translate the trimmed nucleic acid sequence to a protein sequence
-        protein_seq = trimmed_seq.translate(to_stop=True)
-        # Remove stop codons ('*') from the protein sequence
-        cleaned_protein_seq = Seq(str(protein_seq).replace("*", ""))
-        # Create a new SeqRecord, preserving the original header
-        translated_record = SeqRecord(
-            cleaned_protein_seq, id=record.id, description=record.description
-        )
-        translated_records.append(translated_record)
+    Records are written as soon as they are translated, the headers are kept as they are.
+    With a translation_cache path, proteins of CDS translated by earlier runs are read from the cache.
+    """
+    with open_input(input_path, "rt") as input_file, open_output(
+        output_path
+    ) as output_file:
+        records = SimpleFastaParser(input_file)
+        if translation_cache is None:
+            for title, sequence in records:
+                output_file.write(format_fasta(title, translate_sequence(sequence)))
+            return
 
-    # Write the translated protein sequences to the output file
-    with open(output_path, "w") as output_file:
-        SeqIO.write(translated_records, output_file, "fasta")
+        with TranslationCache(
+            translation_cache, CACHE_MODE, translate_sequence, translation_cache_size
+        ) as cache:
+            for batch in batched(records):
+                proteins = cache.translate_batch([sequence for _, sequence in batch])
+                for (title, _), protein in zip(batch, proteins):
+                    output_file.write(format_fasta(title, protein))
+            print(f"Translation cache: {cache.hits} hits, {cache.misses} misses")
 
 
 def main():
-    if len(sys.argv) != 3:
-        print(
-            "Usage: python translate_fasta_no_header_change.py <input_fasta_path> <output_fasta_path>"
-        )
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Translates a CDS fasta file, keeping the headers."
+    )
+    parser.add_argument("input_fasta_path", help="CDS fasta file, plain or gzip")
+    parser.add_argument(
+        "output_fasta_path", help="Protein fasta file, compressed when it ends in .gz"
+    )
+    parser.add_argument(
+        "-tc",
+        "--translation_cache",
+        help="SQLite file caching the proteins of translated CDS across runs",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "-tcs",
+        "--translation_cache_size",
+        help="Size in MB above which the least recently used proteins are evicted from the cache",
+        required=False,
+        default=DEFAULT_MAX_SIZE,
+        type=int,
+    )
+    args = parser.parse_args()
 
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
+    translate_fasta_no_header_change(
+        args.input_fasta_path,
+        args.output_fasta_path,
+        args.translation_cache,
+        args.translation_cache_size,
+    )
 
-    translate_fasta_no_header_change(input_path, output_path)
 
 if __name__ == "__main__":
     main()
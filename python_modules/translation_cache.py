@@ -0,0 +1,133 @@
+import hashlib
+import sqlite3
+import time
+
+# Default size cap of a cache, in MB
+DEFAULT_MAX_SIZE = 1024
+
+# Digests per lookup query, below the SQLite limit of query parameters
+QUERY_CHUNK = 500
+
+# A hit only refreshes the last use of an entry older than this, in seconds
+TOUCH_INTERVAL = 3600
+
+
+def sequence_digest(sequence):
+    return hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+
+
+class TranslationCache:
+    """SQLite cache of translated proteins, shared by every run and worker that uses the same file.
+
+    Entries are keyed by the digest of the nucleotide sequence and a mode naming
+    the translator, so identical CDS of other assemblies or earlier runs are not
+    translated again. When the cache grows over max_size MB the least recently
+    used entries are evicted as it is closed.
+    """
+
+    def __init__(self, path, mode, translator, max_size=DEFAULT_MAX_SIZE):
+        self.mode = mode
+        self.translator = translator
+        self.max_size = max_size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        # Workers of a pool write to the same cache, they wait for each other's transactions
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                " digest BLOB NOT NULL,"
+                " mode TEXT NOT NULL,"
+                " protein TEXT NOT NULL,"
+                " last_used INTEGER NOT NULL,"
+                " PRIMARY KEY (digest, mode)"
+                ") WITHOUT ROWID"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def lookup(self, digests):
+        """Returns {digest: (protein, last_used)} for the digests found in the cache."""
+        found = {}
+        for start in range(0, len(digests), QUERY_CHUNK):
+            chunk = digests[start : start + QUERY_CHUNK]
+            found.update(
+                (digest, (protein, last_used))
+                for digest, protein, last_used in self.connection.execute(
+                    "SELECT digest, protein, last_used FROM translations"
+                    f" WHERE mode = ? AND digest IN ({', '.join('?' * len(chunk))})",
+                    [self.mode, *chunk],
+                )
+            )
+        return found
+
+    def translate_batch(self, sequences):
+        """Returns the protein of each sequence, translating and storing only the ones not cached."""
+        digests = [sequence_digest(sequence) for sequence in sequences]
+        found = self.lookup(list(set(digests)))
+        now = int(time.time())
+
+        proteins = []
+        translated = {}
+        for digest, sequence in zip(digests, sequences):
+            if digest in found:
+                proteins.append(found[digest][0])
+                self.hits += 1
+                continue
+            if digest not in translated:
+                translated[digest] = self.translator(sequence)
+            proteins.append(translated[digest])
+            self.misses += 1
+
+        touched = [
+            (now, self.mode, digest)
+            for digest, (_, last_used) in found.items()
+            if now - last_used > TOUCH_INTERVAL
+        ]
+        if translated or touched:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                    [
+                        (digest, self.mode, protein, now)
+                        for digest, protein in translated.items()
+                    ],
+                )
+                self.connection.executemany(
+                    "UPDATE translations SET last_used = ? WHERE mode = ? AND digest = ?",
+                    touched,
+                )
+        return proteins
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is below max_size.
+
+        The size is the one of the pages in use, pages of evicted entries are reused.
+        """
+        page_size, page_count, free_pages = (
+            self.connection.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ("page_size", "page_count", "freelist_count")
+        )
+        size = (page_count - free_pages) * page_size
+        if size <= self.max_size:
+            return
+
+        # Entries of the average size are evicted down to 90% of the cap
+        rows = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        excess = size - self.max_size * 9 // 10
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM translations WHERE (digest, mode) IN"
+                " (SELECT digest, mode FROM translations ORDER BY last_used LIMIT ?)",
+                (-(-excess * rows // size),),
+            )
@@ -1,24 +1,5 @@
 import requests, sys, csv, re, argparse, time
-
-class Fasta:
-    @staticmethod
-    def parse_generator(fasta_input_path):
-        """simple fasta file reader"""
-        with open(fasta_input_path, "r") as file:
-            sequence_id = None
-            sequence_data = []
-
-            for line in file:
-                line = line.strip()
-                if line.startswith('>'):
-                    if sequence_id is not None:
-                        yield sequence_id, ''.join(sequence_data)
-                    sequence_id = line
-                    sequence_data = []
-                else:
-                    sequence_data.append(line)
-            if sequence_id is not None:
-                yield sequence_id, ''.join(sequence_data)  # Yield the last sequence
+from fasta import Fasta, IndexedFasta
 
 class GetID:
     def __init__(self, input_path, output_path):
@@ -34,12 +15,12 @@ class GetID:
     
     def write_ids(self):
         with open(self.output_path, "w") as output_file:
-            sequence_generator = self.fasta.parse_generator(self.input_path)
-            ids = []
-            for (nuc_id, nuc_sequence) in sequence_generator:
+            header_generator = self.fasta.header_generator(self.input_path)
+            ids = set()
+            for nuc_id in header_generator:
                 gene_id = self.find_gene_id(nuc_id)
                 if gene_id and gene_id not in ids:
-                    ids.append(gene_id)
+                    ids.add(gene_id)
                     output_file.write(gene_id + "\n")
 
 class RetrieveFasta:
@@ -49,6 +30,7 @@ class RetrieveFasta:
         self.output_path = output_path
         self.data_path = data_path
         self.premature_path = premature_path
+        self.database = None
         print("Generated retrieve fasta")
 
     def get_url(self, protein_id):
@@ -57,23 +39,18 @@ class RetrieveFasta:
     def get_missing_fasta(self, gene_id):
         gene_id_full = f"GeneID:{gene_id}"
         print(f"Trying to find {gene_id_full}")
-        with open(self.data_path.rstrip(".tsv"), "r") as data_file, \
-            open(self.premature_path.rstrip(".tsv"), "a") as premature_file:
+        if self.database is None:
+            # Indexed once, every missing GeneID is then a lookup instead of a rescan
+            self.database = IndexedFasta(self.data_path.rstrip(".tsv"), persist_index=False)
+        with open(self.premature_path.rstrip(".tsv"), "a") as premature_file:
             sequences = []
-            found_line = False
-            for line in data_file:
-                if gene_id_full in line:
-                    print(f"Found {gene_id} in {line}")
-                    header = line
-                    found_line = True
-                    continue
-                if found_line:
-                    sequence = line
-                    sequences.append((header,sequence))
-                    found_line = False
+            for record in self.database.get_gene(gene_id):
+                header = record.header_text()
+                print(f"Found {gene_id} in {header}")
+                sequences.append((header, record.sequence().decode()))
             longest_sequence = max(sequences, key=lambda x: len(x[1]))
             print(f"Longest sequence is {longest_sequence}")
-            premature_file.write(f"{longest_sequence[0]}{longest_sequence[1]}")
+            premature_file.write(f"{longest_sequence[0]}\n{longest_sequence[1]}\n")
 
     def id_generator(self):
         with open(self.input_path) as file:
@@ -102,6 +79,8 @@ class RetrieveFasta:
 
                 except requests.exceptions.RequestException as e:
                     print(f"Error retrieving {protein_id}: {e}")
+        if self.database is not None:
+            self.database.close()
 
 class ExtractRefseq:
     def __init__(self, input_path, output_path, data_path):
@@ -126,26 +105,30 @@ class ExtractRefseq:
                     found_section = False
                     yield line[:65]
 
-    def find_sequence(self, alignment):
-        with open(self.data_path, "r") as data_file:
-            found_line = False
-            print(f"Finding: {alignment}")
-            for line in data_file:
-                if alignment in line:
-                    print(f"Found alignment")
-                    header = line
-                    found_line = True
-                    continue
-                if found_line:
-                    return (header, line)
+    def find_sequence(self, database, alignment):
+        print(f"Finding: {alignment}")
+        record = database.get(alignment.split()[0])
+        if record is None or alignment not in record.header_text():
+            record = next(
+                (
+                    record
+                    for record in database.records()
+                    if alignment in record.header_text()
+                ),
+                None,
+            )
+        if record is not None:
+            print(f"Found alignment")
+            return (f"{record.header_text()}\n", f"{record.sequence().decode()}\n")
 
     def write_significant_alignments(self):
         with open(self.input_path, "r") as input_file, \
-            open(self.output_path, "a") as output_file:
+            open(self.output_path, "a") as output_file, \
+            IndexedFasta(self.data_path, persist_index=False) as database:
             
             alignment_generator = self.extract_significant_alignment(input_file)
             for alignment in alignment_generator:
-                fasta_snippet = self.find_sequence(alignment)
+                fasta_snippet = self.find_sequence(database, alignment)
                 output_file.write(f"{fasta_snippet[0]}{fasta_snippet[1]}")
 
 if __name__ == '__main__':